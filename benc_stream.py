@@ -0,0 +1,98 @@
+"""Streaming reader for the aa_isbn13_codes_*.benc.zst dump.
+
+The dump is a zstd compressed bencoded dictionary mapping each prefix (ia,
+md5, ol...) to its packed ISBN intervals. bencodepy.bread() decodes the
+whole dictionary at once; iter_packed_isbns() yields one entry at a time
+while the file is being decompressed, and merge_packed_isbns() walks two
+dumps side by side.
+"""
+
+import zstandard
+
+
+def _read_exactly(stream, size):
+    """Read size bytes into a new bytearray, without intermediate copies."""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    read = 0
+    while read < size:
+        count = stream.readinto(view[read:])
+        if not count:
+            raise ValueError("Truncated bencode data")
+        read += count
+    return buffer
+
+
+def _read_string(stream, first_byte):
+    """Read a bencoded byte string whose first length digit is first_byte."""
+    length = first_byte
+    while True:
+        byte = stream.read(1)
+        if byte == b":":
+            break
+        if not byte.isdigit():
+            raise ValueError(f"Invalid bencode string length {length + byte!r}")
+        length += byte
+    return _read_exactly(stream, int(length))
+
+
+def iter_bencode_dict(stream):
+    """
+    Yield the (key, value) pairs of a bencoded dictionary of byte strings.
+    Keys are bytes, values are bytearrays usable with struct.unpack or
+    numpy.frombuffer without copy.
+    """
+    if stream.read(1) != b"d":
+        raise ValueError("Bencode data is not a dictionary")
+    while True:
+        byte = stream.read(1)
+        if byte == b"e":
+            return
+        if not byte.isdigit():
+            raise ValueError(f"Unexpected bencode key type {byte!r}")
+        key = bytes(_read_string(stream, byte))
+        byte = stream.read(1)
+        if not byte.isdigit():
+            raise ValueError(f"Unexpected bencode value type {byte!r} for {key!r}")
+        yield key, _read_string(stream, byte)
+
+
+def iter_packed_isbns(input_filename):
+    """Yield (prefix, packed_isbns_binary) from a .benc.zst dump, one by one."""
+    with open(input_filename, "rb") as fh:
+        with zstandard.ZstdDecompressor().stream_reader(fh) as reader:
+            yield from iter_bencode_dict(reader)
+
+
+def _check_sorted(items, input_filename):
+    """Pass (prefix, value) pairs through, checking that the prefixes are sorted."""
+    last = None
+    for prefix, value in items:
+        if last is not None and prefix <= last:
+            raise ValueError(f"Prefixes of {input_filename} are not sorted: {last!r} before {prefix!r}")
+        last = prefix
+        yield prefix, value
+
+
+def merge_packed_isbns(previous_filename, input_filename):
+    """
+    Yield (prefix, previous_packed_isbns, packed_isbns) walking two dumps at
+    once in prefix order, None standing for a prefix missing from one of
+    them. Bencoded dictionaries have sorted keys, so only the current entry
+    of each dump is held in memory.
+    """
+    previous = _check_sorted(iter_packed_isbns(previous_filename), previous_filename)
+    current = _check_sorted(iter_packed_isbns(input_filename), input_filename)
+    previous_item = next(previous, None)
+    item = next(current, None)
+    while previous_item is not None or item is not None:
+        if item is None or (previous_item is not None and previous_item[0] < item[0]):
+            yield previous_item[0], previous_item[1], None
+            previous_item = next(previous, None)
+        elif previous_item is None or item[0] < previous_item[0]:
+            yield item[0], None, item[1]
+            item = next(current, None)
+        else:
+            yield item[0], previous_item[1], item[1]
+            previous_item = next(previous, None)
+            item = next(current, None)
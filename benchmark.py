@@ -0,0 +1,262 @@
+"""Time the rendering and GeoJSON scripts on synthetic dumps.
+
+Dumps of each scale (approximate number of ISBNs per dump prefix, with a
+record per 10 ISBNs) are generated with make_synthetic_dumps.py in the
+data directory, once. Every benchmark then runs in a fresh process, its
+setup (reading the dump, preparing the input image...) not being timed,
+and records its duration and the peak resident memory of the process.
+Results are written as JSON; with --compare, they are printed next to the
+ones of a previous run, to spot regressions between versions.
+
+Usage:
+    benchmark.py [options]
+
+Options:
+    -d --data=<dir>         Directory of the synthetic dumps [default: benchmark_data]
+    -s --scales=<list>      Comma separated numbers of ISBNs per dump prefix [default: 10000,100000,1000000]
+    -b --benchmarks=<list>  Comma separated benchmarks to run [default: all]
+    -o --output=<file>      Results file [default: benchmark.json]
+    -l --label=<label>      Label of the results, the git commit by default
+    -c --compare=<file>     Results file of a previous run to compare with
+    -h --help               Show this help message
+
+Example:
+    python benchmark.py -s 100000 -o before.json
+    python benchmark.py -s 100000 -o after.json -c before.json
+"""
+
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from docopt import docopt
+
+from benc_stream import iter_packed_isbns
+from make_synthetic_dumps import DUMP_FILENAME, RECORDS_FILENAME, generate
+from run_report import peak_rss_mb
+
+ISBNS_PER_RECORD = 10
+
+
+def first_packed_isbns(dump_filename):
+    """Packed ISBNs of the first prefix of the dump."""
+    for _, packed_isbns_binary in iter_packed_isbns(dump_filename):
+        return bytes(packed_isbns_binary)
+
+
+def get_recursive_xy_run(get_recursive_xy, dump_filename):
+    """Call get_recursive_xy on every ISBN of the first prefix of the dump."""
+    from isbn_intervals import IntervalSet, iter_positions
+
+    intervals = IntervalSet.from_packed(first_packed_isbns(dump_filename))
+    positions = [int(p) for chunk in iter_positions(intervals.starts, intervals.ends) for p in chunk]
+
+    def run():
+        for position in positions:
+            get_recursive_xy(position)
+
+    return run
+
+
+def bench_get_recursive_xy_hd(dump_filename, records_filename, work_dir):
+    from make_isbn_images_fractal import get_recursive_xy
+
+    return get_recursive_xy_run(get_recursive_xy, dump_filename)
+
+
+def bench_get_recursive_xy_ld(dump_filename, records_filename, work_dir):
+    from make_isbn_images_fractal_cluster import get_recursive_xy
+
+    return get_recursive_xy_run(get_recursive_xy, dump_filename)
+
+
+def bench_color_image_hd(dump_filename, records_filename, work_dir):
+    import PIL.Image
+
+    import make_isbn_images_fractal
+
+    packed_isbns_binary = first_packed_isbns(dump_filename)
+    image = PIL.Image.new("1", (make_isbn_images_fractal.WIDTH, make_isbn_images_fractal.HEIGHT), 0)
+    return lambda: make_isbn_images_fractal.color_image(image, packed_isbns_binary, color=1)
+
+
+def bench_color_image_ld(dump_filename, records_filename, work_dir):
+    import make_isbn_images_fractal_cluster as cluster
+
+    packed_isbns_binary = first_packed_isbns(dump_filename)
+    image = cluster.Image.new("F", (cluster.WIDTH, cluster.HEIGHT), 0.0)
+    return lambda: cluster.color_image(image, packed_isbns_binary, addcolor=1.0 / float(cluster.SCALE_SQUARED))
+
+
+def bench_color_image_all(dump_filename, records_filename, work_dir):
+    import make_isbn_images_fractal_cluster as cluster
+    from isbn_intervals import IntervalSet
+
+    dump = [
+        (prefix, bytes(packed_isbns_binary))
+        for prefix, packed_isbns_binary in iter_packed_isbns(dump_filename)
+    ]
+
+    def run():
+        # Union of the non md5 prefixes, as in main(), then the red image of all
+        all_isbns = IntervalSet()
+        for prefix, packed_isbns_binary in dump:
+            if prefix != b"md5":
+                all_isbns = all_isbns | IntervalSet.from_packed(packed_isbns_binary)
+        image = cluster.Image.new("F", (cluster.WIDTH, cluster.HEIGHT), 0.0)
+        cluster.color_image(image, all_isbns.to_packed(), addcolor=1.0 / float(cluster.SCALE_SQUARED))
+
+    return run
+
+
+def bench_create_pyramid(dump_filename, records_filename, work_dir):
+    import make_isbn_images_fractal_cluster as cluster
+    from isbn_intervals import IntervalSet
+
+    input_dir = f"{work_dir}/images"
+    os.makedirs(input_dir, exist_ok=True)
+    intervals = IntervalSet.from_packed(first_packed_isbns(dump_filename))
+    cluster.prefix_image(intervals).save(f"{input_dir}/ia_bench.png")
+
+    def run():
+        from make_isbn_images_2_tiling import create_pyramid
+
+        create_pyramid(input_dir, "bench", 256, 0, "onetile", [1, 2], f"{work_dir}/tiles", "none", "")
+
+    return run
+
+
+def bench_generate_geojson(dump_filename, records_filename, work_dir):
+    import make_isbn_json
+
+    make_isbn_json.get_recursive_xy = make_isbn_json.get_recursive_xy_ld
+    # Measure a cold run, building the columnar cache of the records
+    shutil.rmtree(f"{records_filename}.columns", ignore_errors=True)
+    return lambda: make_isbn_json.generate_geojson(
+        f"{work_dir}/data.json", 32, label_point=True, publisher_file=records_filename
+    )
+
+
+# Each benchmark prepares its input and returns the function to time
+BENCHMARKS = {
+    "get_recursive_xy_hd": bench_get_recursive_xy_hd,
+    "get_recursive_xy_ld": bench_get_recursive_xy_ld,
+    "color_image_hd": bench_color_image_hd,
+    "color_image_ld": bench_color_image_ld,
+    "color_image_all": bench_color_image_all,
+    "create_pyramid": bench_create_pyramid,
+    "generate_geojson": bench_generate_geojson,
+}
+
+
+def run_benchmark(name, dump_filename, records_filename, work_dir):
+    """Run a benchmark in the current process, its output discarded."""
+    bench = BENCHMARKS[name]
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            run = bench(dump_filename, records_filename, work_dir)
+            setup_rss = peak_rss_mb()
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {"seconds": round(seconds, 4), "setup_rss_mb": round(setup_rss, 1), "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+
+def run_isolated(name, dump_filename, records_filename, work_dir):
+    """Run a benchmark in a new process, so that its peak memory is its own."""
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(run_benchmark, name, dump_filename, records_filename, work_dir).result()
+
+
+def synthetic_dumps(data_dir, scale):
+    """Filenames of the synthetic dumps of a scale, generated if missing."""
+    scale_dir = f"{data_dir}/{scale}"
+    dump_filename = f"{scale_dir}/{DUMP_FILENAME}"
+    records_filename = f"{scale_dir}/{RECORDS_FILENAME}"
+    if not (os.path.exists(dump_filename) and os.path.exists(records_filename)):
+        print(f"Generating synthetic dumps in {scale_dir}...")
+        generate(scale_dir, isbns=scale, records=max(1, scale // ISBNS_PER_RECORD))
+    return dump_filename, records_filename
+
+
+def git_label():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_comparison(results, previous):
+    """Print the durations of results next to the ones of a previous run."""
+    before = {(r["benchmark"], r["scale"]): r for r in previous["results"]}
+    print(f"\n{'benchmark':<22}{'scale':>10}{previous['label']:>14}{results['label']:>14}{'ratio':>8}")
+    for result in results["results"]:
+        old = before.get((result["benchmark"], result["scale"]))
+        if old is None or "seconds" not in old or "seconds" not in result:
+            continue
+        ratio = result["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        print(
+            f"{result['benchmark']:<22}{result['scale']:>10}"
+            f"{old['seconds']:>13.3f}s{result['seconds']:>13.3f}s{ratio:>8.2f}"
+        )
+
+
+def main():
+    args = docopt(__doc__)
+    data_dir = args["--data"]
+    scales = [int(s) for s in args["--scales"].split(",")]
+    names = list(BENCHMARKS) if args["--benchmarks"] == "all" else args["--benchmarks"].split(",")
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmarks {', '.join(unknown)}, use {', '.join(BENCHMARKS)}")
+        sys.exit(1)
+
+    results = {
+        "label": args["--label"] or git_label(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+    for scale in scales:
+        dump_filename, records_filename = synthetic_dumps(data_dir, scale)
+        for name in names:
+            result = run_isolated(name, dump_filename, records_filename, f"{data_dir}/{scale}/work")
+            results["results"].append({"benchmark": name, "scale": scale, **result})
+            if "error" in result:
+                print(f"{name} ({scale}): {result['error']}")
+            else:
+                print(f"{name} ({scale}): {result['seconds']:.3f}s, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    with open(args["--output"], "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args['--output']}")
+
+    if args["--compare"]:
+        with open(args["--compare"]) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Streaming writer for the GeoJSON files of make_isbn_json.py.
+
+Features are written as they are produced instead of being collected in a
+FeatureCollection dict first. Formats:
+- pretty: same bytes as json.dump(feature_collection, f, indent=2)
+- compact: FeatureCollection without whitespace
+- ndjson: one compact feature per line
+Output files ending with .zst are zstd compressed on the fly.
+"""
+
+import io
+import json
+
+import zstandard as zstd
+
+FORMATS = ["pretty", "compact", "ndjson"]
+COMPACT_SEPARATORS = (",", ":")
+
+
+def open_text(filename, mode):
+    """Open a text file, (de)compressing it with zstd if its name ends with .zst."""
+    if not filename.endswith(".zst"):
+        return open(filename, mode)
+    fh = open(filename, mode + "b")
+    if "w" in mode:
+        stream = zstd.ZstdCompressor().stream_writer(fh)
+    else:
+        stream = zstd.ZstdDecompressor().stream_reader(fh)
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+class GeoJSONWriter:
+    """Context manager writing features one by one to a GeoJSON file."""
+
+    def __init__(self, filename, format="pretty"):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown GeoJSON format {format}, use one of {', '.join(FORMATS)}")
+        self.filename = filename
+        self.format = format
+        self.file = None
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open_text(self.filename, "w")
+        if self.format == "pretty":
+            self.file.write('{\n  "type": "FeatureCollection",\n  "features": [')
+        elif self.format == "compact":
+            self.file.write('{"type":"FeatureCollection","features":[')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                if self.format == "pretty":
+                    self.file.write("\n  ]\n}" if self.count else "]\n}")
+                elif self.format == "compact":
+                    self.file.write("]}")
+        finally:
+            self.file.close()
+
+    def write(self, feature):
+        if self.format == "pretty":
+            text = json.dumps(feature, indent=2).replace("\n", "\n    ")
+            self.file.write(("," if self.count else "") + "\n    " + text)
+        elif self.format == "compact":
+            self.file.write(("," if self.count else "") + json.dumps(feature, separators=COMPACT_SEPARATORS))
+        else:
+            self.file.write(json.dumps(feature, separators=COMPACT_SEPARATORS) + "\n")
+        self.count += 1
+
+
+def iter_features(filename):
+    """Yield the features of a GeoJSON or NDJSON file written by GeoJSONWriter."""
+    with open_text(filename, "r") as f:
+        first_line = f.readline()
+        if first_line.startswith('{"type":"Feature"'):
+            yield json.loads(first_line)
+            for line in f:
+                yield json.loads(line)
+        else:
+            yield from json.loads(first_line + f.read())["features"]
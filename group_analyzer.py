@@ -1,55 +1,51 @@
 """ISBN Prefix Analyzer.
 
 Usage:
-    isbn_analyzer.py --prefix=<prefix>
-    isbn_analyzer.py --unique-isbns
+    isbn_analyzer.py [--file=<file>] [--jobs=<n>] [--report=<file>] [--profile=<stage>] --prefix=<prefix>
+    isbn_analyzer.py [--file=<file>] [--jobs=<n>] [--report=<file>] [--profile=<stage>] --prefixes-file=<file>
+    isbn_analyzer.py [--file=<file>] [--jobs=<n>] [--report=<file>] [--profile=<stage>] --unique-isbns
     isbn_analyzer.py (-h | --help)
 
 Options:
     -h --help           Show this screen.
-    --prefix=<prefix>   ISBN prefix to analyze (e.g., "978-0-00")
+    --file=<file>       ISBN group records file [default: annas_archive_meta__aacid__isbngrp_records__20240920T194930Z--20240920T194930Z.jsonl.seekable.zst]
+    --jobs=<n>          Processes parsing the file when building its cache [default: 1]
+    --prefix=<prefix>   ISBN prefix to analyze (e.g., "978-0-00"), or all the prefixes under it with a trailing * (e.g., "978-2*")
+    --prefixes-file=<file>  File with one prefix to analyze per line, as --prefix
     --unique-isbns      Show all unique ISBN prefixes sorted by length
+    --report=<file>     Write a JSON report of the time spent in each stage
+    --profile=<stage>   Profile a stage (unique, records, analyze) with cProfile
 """
 
-import zstandard as zstd
-import json
+import os
 from collections import defaultdict
-import io
 from docopt import docopt
+from isbngrp_cache import load_group_records
+from run_report import RunReport
 
-def get_unique_isbns(file_path):
+def get_unique_isbns(file_path, jobs=1):
     unique_prefixes = set()
     unique_countries = set()
     unique_agencies = set()
     unique_registrants = set()
 
-    with open(file_path, 'rb') as fh:
-        dctx = zstd.ZstdDecompressor()
-        with dctx.stream_reader(fh) as reader:
-            text_stream = io.TextIOWrapper(reader, encoding='utf-8')
-
-            for line in text_stream:
-                try:
-                    record = json.loads(line)
-                    metadata = record.get('metadata', {})
-                    record_data = metadata.get('record', {})
-                    unique_countries.add(record_data.get("country_name"))
-                    unique_agencies.add(record_data.get("agency_name"))
-                    registrant_name =  record_data.get("registrant_name", f'{record_data.get("country_name")} - {record_data.get("agency_name")} - None')
-                    if not registrant_name:
-                        registrant_name = f'{record_data.get("country_name")} - {record_data.get("agency_name")} - None'
-                    unique_registrants.add(registrant_name)
-                    isbns = record_data.get('isbns', [])
-
-                    for isbn in isbns:
-                        if isbn.get('isbn_type') == 'prefix':
-                            unique_prefixes.add(isbn.get('isbn', ''))
-
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    print(f"Error processing line: {e}")
-                    continue
+    for record_data in load_group_records(file_path, jobs=jobs).iter_records():
+        try:
+            unique_countries.add(record_data.get("country_name"))
+            unique_agencies.add(record_data.get("agency_name"))
+            registrant_name =  record_data.get("registrant_name", f'{record_data.get("country_name")} - {record_data.get("agency_name")} - None')
+            if not registrant_name:
+                registrant_name = f'{record_data.get("country_name")} - {record_data.get("agency_name")} - None'
+            unique_registrants.add(registrant_name)
+            isbns = record_data.get('isbns', [])
+
+            for isbn in isbns:
+                if isbn.get('isbn_type') == 'prefix':
+                    unique_prefixes.add(isbn.get('isbn', ''))
+
+        except Exception as e:
+            print(f"Error processing line: {e}")
+            continue
 
     # Sort prefixes first by length, then numerically
     sorted_prefixes = sorted(unique_prefixes, key=lambda x: (len(x.replace('-', '')), x))
@@ -67,45 +63,31 @@ def calculate_possible_books(prefix):
     # Calculate possible combinations
     return 10 ** remaining_digits
 
-def process_zst_file(file_path, target_prefix):
+def analyze_prefix(records, target_prefix):
+    """Registrants of the records having target_prefix, found with the prefix index."""
     registrant_data = defaultdict(lambda: {'count': 0, 'possible_books' : 0, 'isbns': set()})
 
-    with open(file_path, 'rb') as fh:
-        dctx = zstd.ZstdDecompressor()
-        with dctx.stream_reader(fh) as reader:
-            text_stream = io.TextIOWrapper(reader, encoding='utf-8')
-
-            for line in text_stream:
-                try:
-                    record = json.loads(line)
-                    metadata = record.get('metadata', {})
-                    record_data = metadata.get('record', {})
-                    isbns = record_data.get('isbns', [])
-
-                    matching_isbns = [isbn.get('isbn') for isbn in isbns 
-                                    if isbn.get('isbn_type') == 'prefix' 
-                                    and isbn.get('isbn', '') == target_prefix]
-                    
-                    if matching_isbns:
-                        registrant_name = record_data.get('registrant_name', 'Unknown')
-                        possible_books = 0 
-                        for isbn in isbns:
-                            if isbn.get('isbn_type') == 'prefix':
-                                possible_books += calculate_possible_books(isbn.get('isbn'))
-                            elif isbn.get('isbn_type') == 'isbn13':
-                                possible_books += 1
-                            else:
-                                print(isbn)
-                                exit
-                        registrant_data[registrant_name]['possible_books'] += possible_books
-                        registrant_data[registrant_name]['count'] += len(isbns)
-                        registrant_data[registrant_name]['isbns'].update([isbn.get('isbn') for isbn in isbns])
-
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    print(f"Error processing line: {e}")
-                    continue
+    for index in records.find_prefix(target_prefix):
+        try:
+            record_data = records.record(index)
+            isbns = record_data.get('isbns', [])
+            registrant_name = record_data.get('registrant_name', 'Unknown')
+            possible_books = 0 
+            for isbn in isbns:
+                if isbn.get('isbn_type') == 'prefix':
+                    possible_books += calculate_possible_books(isbn.get('isbn'))
+                elif isbn.get('isbn_type') == 'isbn13':
+                    possible_books += 1
+                else:
+                    print(isbn)
+                    exit
+            registrant_data[registrant_name]['possible_books'] += possible_books
+            registrant_data[registrant_name]['count'] += len(isbns)
+            registrant_data[registrant_name]['isbns'].update([isbn.get('isbn') for isbn in isbns])
+
+        except Exception as e:
+            print(f"Error processing line: {e}")
+            continue
 
     # Sort by count in descending order
     sorted_data = sorted(registrant_data.items(), 
@@ -113,15 +95,53 @@ def process_zst_file(file_path, target_prefix):
                         reverse=True)
     return sorted_data
 
+def process_zst_file(file_path, target_prefix, jobs=1):
+    return analyze_prefix(load_group_records(file_path, jobs=jobs), target_prefix)
+
+def expand_prefixes(records, target_prefixes):
+    """Replace the prefixes ending with * by all the known prefixes under them."""
+    for target_prefix in target_prefixes:
+        if target_prefix.endswith('*'):
+            yield from records.prefixes_under(target_prefix[:-1])
+        else:
+            yield target_prefix
+
+def print_prefix_report(target_prefix, results):
+    print(f"\nAnalyzing ISBN prefix: {target_prefix}")
+    print("-" * 70)
+
+    if results:
+        print(results)
+        print(f"{'Registrant Name':40} {'Number of books':15} {'Number of ISBNs':15}")
+        print("-" * 55)
+        
+        # Print top 10 registrants with their ISBNs
+        for registrant, data in results[:10]:
+            print(f"\n{registrant:40} {data['possible_books']:15} {data['count']:15}")
+            print("ISBNs:")
+            for isbn in sorted(data['isbns'])[:20]:  # Show up to 20 ISBNs
+                print(f"    {isbn}")
+            if len(data['isbns']) > 20:
+                print(f"    ... and {len(data['isbns']) - 20} more")
+            print("-" * 55)  # Add separator between registrants
+    else:
+        print(f"No records found for prefix {target_prefix}")
+
+    print(f"\nTotal unique registrants found: {len(results)}")
+
 def main():
     arguments = docopt(__doc__)
-    file_path = "annas_archive_meta__aacid__isbngrp_records__20240920T194930Z--20240920T194930Z.jsonl.seekable.zst"
+    file_path = arguments['--file']
+    jobs = int(arguments['--jobs'])
+    report = RunReport(arguments['--profile'])
 
     if arguments.get('--unique-isbns', ''):
         print("\nListing all unique ISBN prefixes sorted by length:")
         print("-" * 50)
         
-        prefixes, agencies, countries, registrants = get_unique_isbns(file_path)
+        with report.stage("unique", os.path.basename(file_path)) as stage:
+            prefixes, agencies, countries, registrants = get_unique_isbns(file_path, jobs)
+            stage["items"] = len(prefixes)
         current_length = 0
         count = 0
         max_len = 6
@@ -141,34 +161,25 @@ def main():
         print(f"\nTotal unique countries found: {len(countries)}")
         print(f"\nTotal unique agencies found: {len(agencies)}")
         print(f"\nTotal unique registrants found: {len(registrants)}")
+        report.finish(arguments['--report'])
         return
 
-    target_prefix = arguments['--prefix']
-
-    print(f"\nAnalyzing ISBN prefix: {target_prefix}")
-    print("-" * 70)
-
-    results = process_zst_file(file_path, target_prefix)
-
-    if results:
-        print(results)
-        print(f"{'Registrant Name':40} {'Number of books':15} {'Number of ISBNs':15}")
-        print("-" * 55)
-        
-        # Print top 10 registrants with their ISBNs
-        for registrant, data in results[:10]:
-            print(f"\n{registrant:40} {data['possible_books']:15} {data['count']:15}")
-            print("ISBNs:")
-            for isbn in sorted(data['isbns'])[:20]:  # Show up to 20 ISBNs
-                print(f"    {isbn}")
-            if len(data['isbns']) > 20:
-                print(f"    ... and {len(data['isbns']) - 20} more")
-            print("-" * 55)  # Add separator between registrants
+    if arguments['--prefixes-file']:
+        with open(arguments['--prefixes-file']) as f:
+            target_prefixes = [line.strip() for line in f if line.strip()]
     else:
-        print(f"No records found for prefix {target_prefix}")
-
-    print(f"\nTotal unique registrants found: {len(results)}")
-
+        target_prefixes = [arguments['--prefix']]
+
+    with report.stage("records", os.path.basename(file_path)) as stage:
+        records = load_group_records(file_path, jobs=jobs)
+        stage["items"] = len(records)
+        stage["bytes_read"] = os.path.getsize(file_path)
+    for target_prefix in expand_prefixes(records, target_prefixes):
+        with report.stage("analyze", target_prefix) as stage:
+            results = analyze_prefix(records, target_prefix)
+            stage["items"] = len(results)
+        print_prefix_report(target_prefix, results)
+    report.finish(arguments['--report'])
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""Persistent range count index of the packed ISBN intervals of the dump.
+
+The runs of every source (dump prefix: ia, ol, md5...) are decoded once and
+saved as memory-mappable arrays: run starts, run ends and the number of
+ISBNs before each run. Counting the ISBNs of a range or testing membership
+is then a binary search over the runs, without reading the dump again.
+
+Usage:
+    isbn_index.py build [options] <index_dir>
+    isbn_index.py count <index_dir> <source> <prefix>...
+    isbn_index.py contains <index_dir> <source> <isbn>...
+    isbn_index.py (-h | --help)
+
+Options:
+    -i --input=<file>   Input filename [default: aa_isbn13_codes_20241204T185335Z.benc.zst]
+    -h --help           Show this help message
+
+Example:
+    python isbn_index.py build isbn_index
+    python isbn_index.py count isbn_index ol 978-3-16 978-2
+    python isbn_index.py contains isbn_index md5 978-3-16-148410-0
+"""
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+from docopt import docopt
+
+from benc_stream import iter_packed_isbns
+from isbn_intervals import IntervalSet
+from isbn_registry import ISBN12_OFFSET, prefix_digits, prefix_range
+
+
+def isbn_position(isbn):
+    """Position of an ISBN13 (with or without check digit and hyphens)."""
+    digits = prefix_digits(isbn)
+    if len(digits) not in (12, 13):
+        raise ValueError(f"Invalid ISBN13 {isbn}")
+    return int(digits[:12]) - ISBN12_OFFSET
+
+
+def build_index(input_filename, index_dir):
+    """Decode the runs of every source of the dump into index_dir."""
+    tmp_dir = f"{index_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    sources = {}
+    for prefix, packed_isbns_binary in iter_packed_isbns(input_filename):
+        source = prefix.decode()
+        intervals = IntervalSet.from_packed(packed_isbns_binary)
+        print(f"Indexing {source}: {len(intervals)} runs, {intervals.count()} ISBNs")
+        np.save(f"{tmp_dir}/{source}_starts.npy", intervals.starts)
+        np.save(f"{tmp_dir}/{source}_ends.npy", intervals.ends)
+        np.save(f"{tmp_dir}/{source}_cumulative.npy", intervals.cumulative)
+        sources[source] = {"runs": len(intervals), "isbns": intervals.count()}
+    with open(f"{tmp_dir}/sources.json", "w") as f:
+        json.dump({"input": os.path.basename(input_filename), "sources": sources}, f, indent=2)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.rename(tmp_dir, index_dir)
+
+
+class RangeIndex:
+    """Memory-mapped runs of the sources of an index directory."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(f"{index_dir}/sources.json") as f:
+            self.sources = json.load(f)["sources"]
+        self._intervals = {}
+
+    def intervals(self, source):
+        """IntervalSet of a source, backed by the memory-mapped arrays."""
+        if source not in self.sources:
+            raise KeyError(f"Unknown source {source}, available: {', '.join(self.sources)}")
+        if source not in self._intervals:
+            arrays = [
+                np.load(f"{self.index_dir}/{source}_{name}.npy", mmap_mode="r")
+                for name in ("starts", "ends", "cumulative")
+            ]
+            self._intervals[source] = IntervalSet(*arrays)
+        return self._intervals[source]
+
+    def count(self, source, start, end):
+        """Number of ISBNs of source with a position in [start, end)."""
+        return int(self.intervals(source).count_range(start, end))
+
+    def count_prefix(self, source, prefix):
+        """Number of ISBNs of source under a prefix like 978-3-16."""
+        return self.count(source, *prefix_range(prefix))
+
+    def contains(self, source, isbns):
+        """Tell which ISBN13s (strings, check digit optional) are in source."""
+        positions = np.array([isbn_position(isbn) for isbn in isbns], dtype=np.int64)
+        return self.intervals(source).contains(positions).tolist()
+
+
+def main():
+    args = docopt(__doc__)
+    index_dir = args["<index_dir>"]
+    if args["build"]:
+        build_index(args["--input"], index_dir)
+        print(f"Index written to {index_dir}")
+        return
+
+    index = RangeIndex(index_dir)
+    source = args["<source>"]
+    if source not in index.sources:
+        print(f"Unknown source {source}, available: {', '.join(index.sources)}")
+        sys.exit(1)
+    if args["count"]:
+        for prefix in args["<prefix>"]:
+            print(f"{prefix}: {index.count_prefix(source, prefix)}")
+    else:
+        isbns = args["<isbn>"]
+        for isbn, found in zip(isbns, index.contains(source, isbns)):
+            print(f"{isbn}: {'yes' if found else 'no'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Helpers to work on the packed ISBN intervals of the aa_isbn13_codes dump.
+
+Each prefix of the dump is a packed binary of uint32 values alternating
+between `isbn_streak` and `gap_size`, starting with a streak. Positions are
+offsets from 978000000000 (ISBN-13 without check digit).
+"""
+
+import numpy as np
+
+POSITIONS_CHUNK = 1 << 22
+
+
+def decode_intervals(packed_isbns_binary):
+    """
+    Decode packed ISBN intervals into two int64 arrays (starts, ends) of
+    positions. Ends are exclusive and empty streaks are dropped.
+    """
+    values = np.frombuffer(
+        packed_isbns_binary, dtype=np.uint32, count=len(packed_isbns_binary) // 4
+    ).astype(np.int64)
+    bounds = np.cumsum(values)
+    ends = bounds[0::2]
+    starts = ends - values[0::2]
+    not_empty = starts < ends
+    return starts[not_empty], ends[not_empty]
+
+
+def count_isbns(packed_isbns_binary):
+    """Number of ISBNs of packed ISBN intervals, without decoding them."""
+    values = np.frombuffer(
+        packed_isbns_binary, dtype=np.uint32, count=len(packed_isbns_binary) // 4
+    )
+    return int(values[0::2].sum(dtype=np.int64))
+
+
+def iter_positions(starts, ends, chunk_size=POSITIONS_CHUNK):
+    """
+    Yield every position covered by the intervals as int64 arrays of at most
+    chunk_size items, in increasing order.
+    """
+    lengths = ends - starts
+    cumulative = np.cumsum(lengths)
+    total = int(cumulative[-1]) if len(cumulative) else 0
+    for first in range(0, total, chunk_size):
+        ranks = np.arange(first, min(first + chunk_size, total), dtype=np.int64)
+        index = np.searchsorted(cumulative, ranks, side="right")
+        yield starts[index] + ranks - (cumulative[index] - lengths[index])
+
+
+class IntervalSet:
+    """
+    Set of positions stored as sorted, disjoint and non-adjacent half-open
+    intervals [starts[i], ends[i]). Memory is proportional to the number of
+    runs, not to the number of positions.
+    """
+
+    def __init__(self, starts=None, ends=None, cumulative=None):
+        """
+        starts/ends must already be sorted, disjoint and non-adjacent.
+        cumulative, computed when first needed if not given, is the number
+        of positions before each run followed by the total.
+        """
+        if starts is None:
+            starts = np.zeros(0, dtype=np.int64)
+            ends = np.zeros(0, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self._cumulative = cumulative
+
+    @property
+    def cumulative(self):
+        if self._cumulative is None:
+            self._cumulative = np.concatenate(([0], np.cumsum(self.ends - self.starts)))
+        return self._cumulative
+
+    @classmethod
+    def from_packed(cls, packed_isbns_binary):
+        return cls.from_intervals(*decode_intervals(packed_isbns_binary))
+
+    @classmethod
+    def from_intervals(cls, starts, ends):
+        """Build a set from arbitrary (possibly overlapping) intervals."""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        not_empty = starts < ends
+        starts = starts[not_empty]
+        ends = ends[not_empty]
+        if len(starts) == 0:
+            return cls()
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        ends = np.maximum.accumulate(ends[order])
+        # A new run begins where the start is past every previous end.
+        new_run = np.ones(len(starts), dtype=bool)
+        new_run[1:] = starts[1:] > ends[:-1]
+        first = np.flatnonzero(new_run)
+        last = np.append(first[1:], len(starts)) - 1
+        return cls(starts[first], ends[last])
+
+    def to_packed(self):
+        """Encode the set back to the dump's streak/gap uint32 format."""
+        gaps = self.starts - np.concatenate(([0], self.ends[:-1]))
+        values = np.empty(2 * len(self.starts) + 1, dtype=np.uint32)
+        values[0] = 0
+        values[1::2] = gaps
+        values[2::2] = self.ends - self.starts
+        if len(gaps) and gaps[0] == 0:
+            values = values[2:]
+        return values.tobytes()
+
+    def to_bytes(self):
+        """Raw int64 starts then ends, read back without decoding by from_bytes()."""
+        return np.concatenate((self.starts, self.ends)).tobytes()
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        runs = np.frombuffer(buffer, dtype=np.int64)
+        return cls(runs[: len(runs) // 2], runs[len(runs) // 2 :])
+
+    def __len__(self):
+        """Number of runs."""
+        return len(self.starts)
+
+    def count(self):
+        """Number of positions."""
+        return int(np.sum(self.ends - self.starts))
+
+    def count_before(self, positions):
+        """Number of positions of the set lower than each of positions."""
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(self.starts) == 0:
+            return np.zeros(positions.shape, dtype=np.int64)
+        cumulative = self.cumulative
+        # Runs starting at or before the position, the last one may end after it.
+        index = np.searchsorted(self.starts, positions, side="right")
+        overshoot = np.maximum(self.ends[np.maximum(index - 1, 0)] - positions, 0)
+        return np.where(index > 0, cumulative[index] - overshoot, 0)
+
+    def count_range(self, starts, ends):
+        """Number of positions of the set in each [starts, ends) range."""
+        return self.count_before(ends) - self.count_before(starts)
+
+    def contains(self, positions):
+        """Boolean mask telling which positions belong to the set."""
+        if len(self.starts) == 0:
+            return np.zeros(np.shape(positions), dtype=bool)
+        index = np.searchsorted(self.starts, positions, side="right") - 1
+        return (index >= 0) & (positions < self.ends[np.maximum(index, 0)])
+
+    def clip(self, window_starts, window_ends):
+        """
+        Positions of the set within the disjoint windows [window_starts[i],
+        window_ends[i]). Unlike intersection(), only the runs overlapping
+        the windows are read.
+        """
+        order = np.argsort(window_starts)
+        window_starts = np.asarray(window_starts, dtype=np.int64)[order]
+        window_ends = np.asarray(window_ends, dtype=np.int64)[order]
+        first = np.searchsorted(self.ends, window_starts, side="right")
+        last = np.searchsorted(self.starts, window_ends, side="left")
+        counts = np.maximum(last - first, 0)
+        window = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(len(window)) - np.repeat(np.cumsum(counts) - counts, counts)
+        runs = first[window] + offsets
+        # Runs crossing from a window to the next adjacent one are merged back
+        return IntervalSet.from_intervals(
+            np.maximum(self.starts[runs], window_starts[window]),
+            np.minimum(self.ends[runs], window_ends[window]),
+        )
+
+    def _combine(self, other, keep):
+        """
+        Apply a boolean operation on the elementary segments delimited by the
+        bounds of both sets. keep(in_self, in_other) returns a boolean mask.
+        """
+        bounds = np.unique(
+            np.concatenate((self.starts, self.ends, other.starts, other.ends))
+        )
+        if len(bounds) < 2:
+            return IntervalSet()
+        segment_starts = bounds[:-1]
+        kept = keep(self.contains(segment_starts), other.contains(segment_starts))
+        # Merge consecutive kept segments into runs.
+        previous = np.concatenate(([False], kept[:-1]))
+        following = np.concatenate((kept[1:], [False]))
+        return IntervalSet(
+            segment_starts[kept & ~previous], bounds[1:][kept & ~following]
+        )
+
+    def union(self, other):
+        return self._combine(other, lambda a, b: a | b)
+
+    def intersection(self, other):
+        return self._combine(other, lambda a, b: a & b)
+
+    def difference(self, other):
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def symmetric_difference(self, other):
+        return self._combine(other, lambda a, b: a ^ b)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
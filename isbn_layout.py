@@ -0,0 +1,119 @@
+"""Arithmetic mapping between ISBN positions and image pixels.
+
+A position is an ISBN without check digit minus 978000000000, written on
+LEN_SHORT_ISBN digits. The leading len(vector) digits alternately move the
+pixel down (even indexes) and right (odd indexes) by digit * vector[i]. The
+remaining tail digits form a number which is divided by positions_per_pixel
+and laid out row by row in a block tail_width pixels wide.
+
+Both mappings accept a scalar (returning Python ints) or a NumPy array.
+"""
+
+import numpy as np
+
+LEN_SHORT_ISBN = 10
+DIGITS_PER_TABLE = 3
+
+
+class Layout:
+    def __init__(self, width, height, vector, positions_per_pixel=1, tail_width=1):
+        self.width = width
+        self.height = height
+        self.vector = list(vector)
+        self.positions_per_pixel = positions_per_pixel
+        self.tail_width = tail_width
+        self.tail_digits = LEN_SHORT_ISBN - len(self.vector)
+
+        # Forward tables: the position is cut into chunks of digits and each
+        # chunk value is looked up to get its (x, y) contribution.
+        self._chunks = []
+        head = len(self.vector)
+        for first in range(0, head, DIGITS_PER_TABLE):
+            last = min(first + DIGITS_PER_TABLE, head)
+            self._add_chunk(first, last, self._head_xy)
+        self._add_chunk(head, LEN_SHORT_ISBN, self._tail_xy)
+        self._chunks_np = [
+            (divisor, modulus, np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64))
+            for divisor, modulus, xs, ys in self._chunks
+        ]
+
+        # Inverse tables: x and y contribute independently to the position.
+        self._x_positions = self._axis_positions(width, 0)
+        self._y_positions = self._axis_positions(height, 1)
+        self._x_positions_np = np.array(self._x_positions, dtype=np.int64)
+        self._y_positions_np = np.array(self._y_positions, dtype=np.int64)
+
+    def _head_xy(self, first, value, length):
+        coords = [0, 0]
+        for i in range(first, first + length):
+            digit = value // 10 ** (first + length - 1 - i) % 10
+            coords[(i + 1) % 2] += digit * self.vector[i]
+        return coords
+
+    def _tail_xy(self, first, value, length):
+        block = value // self.positions_per_pixel
+        return [block % self.tail_width, block // self.tail_width]
+
+    def _add_chunk(self, first, last, chunk_xy):
+        length = last - first
+        xs = []
+        ys = []
+        for value in range(10**length):
+            x, y = chunk_xy(first, value, length)
+            xs.append(x)
+            ys.append(y)
+        self._chunks.append((10 ** (LEN_SHORT_ISBN - last), 10**length, xs, ys))
+
+    def _axis_positions(self, size, axis):
+        """Position contribution of each x (axis 0) or y (axis 1)."""
+        positions = []
+        for coord in range(size):
+            position = 0
+            for i, step in enumerate(self.vector):
+                if (i + 1) % 2 == axis:
+                    digit, coord = divmod(coord, step)
+                    position += digit * 10 ** (LEN_SHORT_ISBN - 1 - i)
+            if axis == 0:
+                position += coord * self.positions_per_pixel
+            else:
+                position += coord * self.tail_width * self.positions_per_pixel
+            positions.append(position)
+        return positions
+
+    def get_xy(self, positions):
+        """Return the (x, y) pixel of each position."""
+        if np.ndim(positions) == 0:
+            position = int(positions)
+            x = y = 0
+            for divisor, modulus, xs, ys in self._chunks:
+                index = position // divisor % modulus
+                x += xs[index]
+                y += ys[index]
+            return x, y
+
+        positions = np.asarray(positions, dtype=np.int64)
+        x = np.zeros(positions.shape, dtype=np.int64)
+        y = np.zeros(positions.shape, dtype=np.int64)
+        for divisor, modulus, xs, ys in self._chunks_np:
+            index = positions // divisor % modulus
+            x += xs[index]
+            y += ys[index]
+        return x, y
+
+    def find_position(self, x, y):
+        """
+        Return the first position mapped on pixel (x, y). Pixels outside of
+        the image give None for scalars and -1 in arrays.
+        """
+        if np.ndim(x) == 0 and np.ndim(y) == 0:
+            x = int(x)
+            y = int(y)
+            if 0 <= x < self.width and 0 <= y < self.height:
+                return self._x_positions[x] + self._y_positions[y]
+            return None
+
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64))
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        positions = np.full(x.shape, -1, dtype=np.int64)
+        positions[inside] = self._x_positions_np[x[inside]] + self._y_positions_np[y[inside]]
+        return positions
@@ -0,0 +1,146 @@
+"""Hit test of the map: from a point to its ISBN range, country and publisher.
+
+The index is built from the country and publisher rectangle features of
+make_isbn_json.py (a GeoJSON or NDJSON file, or the feature generator). A
+point in map units is turned into an image pixel with the layout of the
+images, and its ISBN range matched against the country and publisher
+prefixes. At a given zoom, only the publishers whose feature is shown at
+that zoom (minzoom property, or the vector_tiles.py --lod rule) match.
+
+Usage:
+    isbn_lookup.py [options] <input> <x> <y> [<zoom>]
+
+Options:
+    --scale=<scale>         GeoJSON scale factor used to generate the input [default: 32]
+    --hd                    Input generated with --hd
+    -t --tile-size=<n>      Vector tile size in map units at the max zoom [default: 512]
+    -h --help               Show this help message
+
+Example:
+    python isbn_lookup.py data_hd.json 81234 40321 7 --scale 4 --hd
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from docopt import docopt
+
+from geojson_stream import iter_features
+from isbn_registry import ISBN12_OFFSET, PrefixTable, prefix_digits
+from vector_tiles import default_max_zoom, feature_zooms
+
+class Hit(namedtuple("Hit", ["first_isbn", "last_isbn", "country_prefix", "country", "publisher_prefix", "registrant"])):
+    """
+    ISBN12 range of a pixel, with its country and publisher. Both prefixes
+    are given as digits only, like 978207, or None when nothing matches.
+    """
+
+    __slots__ = ()
+
+
+class HitIndex:
+    def __init__(self, layout, scale, countries, publishers, tile_size=512, max_zoom=None):
+        """
+        countries maps prefixes to country names, publishers is a list of
+        (prefix, registrant, minzoom).
+        """
+        self.layout = layout
+        self.scale = scale
+        self.tile_size = tile_size
+        if max_zoom is None:
+            max_zoom = default_max_zoom(layout.width * scale, layout.height * scale, tile_size)
+        self.max_zoom = max_zoom
+        self.countries = PrefixTable(countries)
+        self.country_names = list(countries.values())
+        self.publishers = PrefixTable(prefix for prefix, _, _ in publishers)
+        self.registrants = [registrant for _, registrant, _ in publishers]
+        self.publisher_zooms = np.array([minzoom for _, _, minzoom in publishers], dtype=np.int64)
+
+    @classmethod
+    def from_features(cls, features, layout, scale, tile_size=512, max_zoom=None):
+        """Index the rectangle features of make_isbn_json.py."""
+        if max_zoom is None:
+            max_zoom = default_max_zoom(layout.width * scale, layout.height * scale, tile_size)
+        countries = {}
+        publishers = []
+        for feature in features:
+            if feature["geometry"]["type"] != "Polygon":
+                continue
+            properties = feature["properties"]
+            if properties["type"] == "country":
+                countries[properties["prefix"]] = properties["label"]
+            else:
+                minzoom = properties.get("minzoom")
+                if minzoom is None:
+                    minzoom = feature_zooms(feature, 0, max_zoom)[0]
+                publishers.append((properties["prefix"], properties["label"], minzoom))
+        return cls(layout, scale, countries, publishers, tile_size, max_zoom)
+
+    def _visible(self, zoom):
+        if zoom is None:
+            return None
+        return self.publisher_zooms <= zoom
+
+    def lookup(self, x, y, zoom=None):
+        """
+        Hit at map point (x, y), or None outside of the image. Without zoom,
+        the longest publisher prefix matches whatever its size.
+        """
+        position = self.layout.find_position(int(x // self.scale), int(y // self.scale))
+        if position is None:
+            return None
+        first_isbn = ISBN12_OFFSET + position
+        country = self.countries.match(first_isbn)
+        publisher = self.publishers.match(first_isbn, self._visible(zoom))
+        return Hit(
+            first_isbn,
+            first_isbn + self.layout.positions_per_pixel - 1,
+            None if country is None else prefix_digits(self.countries.prefixes[country]),
+            None if country is None else self.country_names[country],
+            None if publisher is None else prefix_digits(self.publishers.prefixes[publisher]),
+            None if publisher is None else self.registrants[publisher],
+        )
+
+    def lookup_array(self, x, y, zoom=None):
+        """
+        Vectorized lookup() over map points: returns the first ISBN12 of each
+        point (-1 outside of the image), and the indices of their country in
+        country_names and of their publisher in registrants (-1 if none).
+        """
+        positions = self.layout.find_position(
+            np.floor_divide(x, self.scale).astype(np.int64), np.floor_divide(y, self.scale).astype(np.int64)
+        )
+        inside = positions >= 0
+        first_isbns = np.where(inside, ISBN12_OFFSET + positions, -1)
+        countries = np.where(inside, self.countries.match_array(first_isbns), -1)
+        publishers = np.where(inside, self.publishers.match_array(first_isbns, self._visible(zoom)), -1)
+        return first_isbns, countries, publishers
+
+    def lookup_tile(self, zoom, col, row):
+        """lookup_array() of the center of every pixel of a vector tile."""
+        pixel = 2 ** (self.max_zoom - zoom)
+        side = self.tile_size * pixel
+        centers = (np.arange(self.tile_size) + 0.5) * pixel
+        return self.lookup_array(col * side + centers[None, :], row * side + centers[:, None], zoom)
+
+
+def main():
+    args = docopt(__doc__)
+    scale = int(args["--scale"])
+    if args["--hd"]:
+        from make_isbn_images_fractal import LAYOUT
+    else:
+        from make_isbn_images_fractal_cluster import LAYOUT
+    index = HitIndex.from_features(iter_features(args["<input>"]), LAYOUT, scale, int(args["--tile-size"]))
+    zoom = int(args["<zoom>"]) if args["<zoom>"] is not None else None
+    hit = index.lookup(float(args["<x>"]), float(args["<y>"]), zoom)
+    if hit is None:
+        print("Outside of the map")
+        return
+    print(f"ISBN range: {hit.first_isbn}-{hit.last_isbn}")
+    print(f"Country: {hit.country} ({hit.country_prefix})")
+    print(f"Publisher: {hit.registrant} ({hit.publisher_prefix})")
+
+
+if __name__ == "__main__":
+    main()
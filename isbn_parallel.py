@@ -0,0 +1,161 @@
+"""Render prefixes of the dump in a pool of worker processes.
+
+The packed ISBN binaries are handed to the workers through shared memory
+blocks instead of being pickled with the task. render_dump() is the loop of
+the image scripts: the images of each prefix, restored from the render
+cache or rendered in the pool, then the combined images of all prefixes.
+"""
+
+import concurrent.futures
+from multiprocessing import shared_memory
+
+from isbn_intervals import IntervalSet
+from render_cache import cache_key
+from run_report import stage
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks the block, but workers share the
+        # resource tracker of the parent, which unlinks it.
+        return shared_memory.SharedMemory(name=name)
+
+
+def _run_shared(fn, name, size, args):
+    """Worker side: call fn(packed_isbns_binary, *args) on the shared block."""
+    shm = _attach_shared_memory(name)
+    packed_isbns_binary = shm.buf[:size]
+    try:
+        return fn(packed_isbns_binary, *args)
+    finally:
+        packed_isbns_binary.release()
+        shm.close()
+
+
+class PrefixPool:
+    """
+    Run fn(packed_isbns_binary, *args) tasks in jobs processes, or inline
+    when jobs is 1. At most 2 * jobs tasks are in flight, so the blocks kept
+    in shared memory stay bounded while the dump is being read.
+    on_result, if given, is called with the return value of every task.
+    """
+
+    def __init__(self, jobs, on_result=None):
+        self.jobs = jobs
+        self.on_result = on_result
+        self.executor = None
+        self.pending = {}
+
+    def __enter__(self):
+        if self.jobs > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=exc_type is not None)
+            for shm in self.pending.values():
+                shm.close()
+                shm.unlink()
+            self.pending = {}
+
+    def submit(self, fn, packed_isbns_binary, *args):
+        if self.executor is None:
+            self._result(fn(packed_isbns_binary, *args))
+            return
+        while len(self.pending) >= 2 * self.jobs:
+            self._collect(concurrent.futures.FIRST_COMPLETED)
+
+        size = len(packed_isbns_binary)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        shm.buf[:size] = packed_isbns_binary
+        future = self.executor.submit(_run_shared, fn, shm.name, size, args)
+        self.pending[future] = shm
+
+    def wait(self):
+        """Wait for all submitted tasks, raising the first worker error."""
+        while self.pending:
+            self._collect(concurrent.futures.ALL_COMPLETED)
+
+    def _collect(self, return_when):
+        done, _ = concurrent.futures.wait(self.pending, return_when=return_when)
+        for future in done:
+            shm = self.pending.pop(future)
+            shm.close()
+            shm.unlink()
+            self._result(future.result())
+
+    def _result(self, result):
+        if self.on_result is not None:
+            self.on_result(result)
+
+
+def render_dump(packed_isbns, output_dir, outputs, submit, render_all, jobs=1, cache=None, report=None):
+    """
+    Render the images of every (prefix, packed_isbns_binary) of packed_isbns
+    and the combined image of all of them, as <output_dir>/<prefix><suffix>.png
+    and <output_dir>/all<suffix>.png.
+
+    outputs maps each output to (suffix, cache_options), the options of its
+    render cache keys. submit(pool, packed_isbns_binary, intervals, images)
+    submits the render of the images [(output, filename)] of a prefix to the
+    PrefixPool pool, render_all(output, filename, all_isbns, md5_isbns)
+    renders a combined image, md5 ISBNs being kept apart from the others.
+    Images whose key is in the RenderCache cache are restored instead, and
+    the rendered ones are stored in it.
+    """
+    # (key, filename) of the images to store in the cache once rendered
+    rendered = []
+    prefix_keys = {output: [] for output in outputs}
+    all_isbns = IntervalSet()
+    md5_isbns = IntervalSet()
+    with PrefixPool(jobs, on_result=None if report is None else report.merge) as pool:
+        for prefix, packed_isbns_binary in packed_isbns:
+            images = []
+            for output, (suffix, cache_options) in outputs.items():
+                filename = f"{output_dir}/{prefix.decode()}{suffix}.png"
+                key = None
+                if cache is not None:
+                    key = cache_key(packed_isbns_binary, *cache_options)
+                    prefix_keys[output].append(prefix + b":" + key.encode())
+                if key is not None and cache.restore(key, filename):
+                    print(f"Restored {filename} from the cache")
+                else:
+                    images.append((output, filename))
+                    rendered.append((key, filename))
+
+            # ISBNs present in several prefixes are only counted once in all
+            with stage(report, "union", prefix.decode()) as union_stage:
+                intervals = IntervalSet.from_packed(packed_isbns_binary)
+                if prefix == b"md5":
+                    md5_isbns = intervals
+                else:
+                    all_isbns = all_isbns | intervals
+                union_stage["items"] = intervals.count()
+            if images:
+                submit(pool, packed_isbns_binary, intervals, images)
+
+    if cache is not None:
+        for key, filename in rendered:
+            cache.store(key, filename)
+
+    for output, (suffix, cache_options) in outputs.items():
+        filename = f"{output_dir}/all{suffix}.png"
+        print(f"### Generating {filename}...")
+        all_key = None
+        if cache is not None:
+            all_key = cache_key(b" ".join(prefix_keys[output]), "all", *cache_options)
+            if cache.restore(all_key, filename):
+                print(f"Restored {filename} from the cache")
+                continue
+        render_all(output, filename, all_isbns, md5_isbns)
+        if all_key is not None:
+            cache.store(all_key, filename)
+    if cache is not None:
+        cache.print_stats()
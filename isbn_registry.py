@@ -0,0 +1,249 @@
+"""Registration group and publisher prefixes, matched against ISBNs.
+
+ISBNs are handled as ISBN12 integers (ISBN13 without check digit), i.e.
+978000000000 + position. A prefix of L digits matches the ISBN12s whose
+first L digits are the prefix. Prefixes are matched one length at a time,
+longest first, with a dict for single ISBNs and a binary search over the
+sorted prefixes of each length for arrays.
+
+Counts per prefix are computed from the ISBN intervals of the dump with
+IntervalSet.count_range(), without enumerating the ISBNs. An ISBN is counted
+for its longest matching prefix only.
+
+Usage:
+    isbn_registry.py [options]
+
+Options:
+    -i --input=<file>           Input filename [default: aa_isbn13_codes_20241204T185335Z.benc.zst]
+    -p --publisher-file=<file>  Also count per publisher prefix from this isbngrp records file
+    --max-prefix-len=<len>      Maximum prefix length for publishers [default: 6]
+    -o --output=<file>          Write the counts as JSON, per dump prefix then country/publisher prefix
+    -n --top=<n>                Number of countries printed per dump prefix [default: 10]
+    -h --help                   Show this help message
+
+Example:
+    python isbn_registry.py -p annas_archive_meta__aacid__isbngrp_records__20240920T194930Z--20240920T194930Z.jsonl.seekable.zst -o counts.json
+"""
+
+import json
+
+import numpy as np
+import tqdm
+from docopt import docopt
+
+from benc_stream import iter_packed_isbns
+from isbn_intervals import IntervalSet
+from isbngrp_cache import MISSING, NULL, load_group_records
+
+ISBN12_OFFSET = 978000000000
+ISBN12_DIGITS = 12
+RECORDS_CHUNK = 1 << 16
+
+countries={'978-0':'English language','978-1':'English language','978-2':'French language','978-3':'German language','978-4':'Japan','978-5':'former U.S.S.R','978-600':'Iran','978-601':'Kazakhstan','978-602':'Indonesia','978-603':'Saudi Arabia','978-604':'Vietnam','978-605':'Turkey','978-606':'Romania','978-607':'Mexico','978-608':'North Macedonia','978-609':'Lithuania','978-611':'Thailand','978-612':'Peru','978-613':'Mauritius','978-614':'Lebanon','978-615':'Hungary','978-616':'Thailand','978-617':'Ukraine','978-618':'Greece','978-619':'Bulgaria','978-620':'Mauritius','978-621':'Philippines','978-622':'Iran','978-623':'Indonesia','978-624':'Sri Lanka','978-625':'Turkey','978-626':'Taiwan','978-627':'Pakistan','978-628':'Colombia','978-629':'Malaysia','978-630':'Romania','978-631':'Argentina','978-65':'Brazil','978-7': "China, People's Republic", '978-80':'former Czechoslovakia','978-81':'India','978-82':'Norway','978-83':'Poland','978-84':'Spain','978-85':'Brazil','978-86':'former Yugoslavia','978-87':'Denmark','978-88':'Italy','978-89':'Korea, Republic','978-90':'Netherlands','978-91':'Sweden','978-92':'International NGO Publishers and EU Organizations','978-93':'India','978-94':'Netherlands','978-950':'Argentina','978-951':'Finland','978-952':'Finland','978-953':'Croatia','978-954':'Bulgaria','978-955':'Sri Lanka','978-956':'Chile','978-957':'Taiwan','978-958':'Colombia','978-959':'Cuba','978-960':'Greece','978-961':'Slovenia','978-962':'Hong Kong, China','978-963':'Hungary','978-964':'Iran','978-965':'Israel','978-966':'Ukraine','978-967':'Malaysia','978-968':'Mexico','978-969':'Pakistan','978-970':'Mexico','978-971':'Philippines','978-972':'Portugal','978-973':'Romania','978-974':'Thailand','978-975':'Turkey','978-976':'Caribbean Community','978-977':'Egypt','978-978':'Nigeria','978-979':'Indonesia','978-980':'Venezuela','978-981':'Singapore','978-982':'South Pacific','978-983':'Malaysia','978-984':'Bangladesh','978-985':'Belarus','978-986':'Taiwan','978-987':'Argentina','978-988':'Hong Kong, China','978-989':'Portugal','978-9910':'Uzbekistan','978-9911':'Montenegro','978-9912':'Tanzania','978-9913':'Uganda','978-9914':'Kenya','978-9915':'Uruguay','978-9916':'Estonia','978-9917':'Bolivia','978-9918':'Malta','978-9919':'Mongolia','978-9920':'Morocco','978-9921':'Kuwait','978-9922':'Iraq','978-9923':'Jordan','978-9924':'Cambodia','978-9925':'Cyprus','978-9926':'Bosnia and Herzegovina','978-9927':'Qatar','978-9928':'Albania','978-9929':'Guatemala','978-9930':'Costa Rica','978-9931':'Algeria','978-9932': "Lao People's Democratic Republic", '978-9933':'Syria','978-9934':'Latvia','978-9935':'Iceland','978-9936':'Afghanistan','978-9937':'Nepal','978-9938':'Tunisia','978-9939':'Armenia','978-9940':'Montenegro','978-9941':'Georgia','978-9942':'Ecuador','978-9943':'Uzbekistan','978-9944':'Turkey','978-9945':'Dominican Republic','978-9946':'Korea, P.D.R.','978-9947':'Algeria','978-9948':'United Arab Emirates','978-9949':'Estonia','978-9950':'Palestine','978-9951':'Kosova','978-9952':'Azerbaijan','978-9953':'Lebanon','978-9954':'Morocco','978-9955':'Lithuania','978-9956':'Cameroon','978-9957':'Jordan','978-9958':'Bosnia and Herzegovina','978-9959':'Libya','978-9960':'Saudi Arabia','978-9961':'Algeria','978-9962':'Panama','978-9963':'Cyprus','978-9964':'Ghana','978-9965':'Kazakhstan','978-9966':'Kenya','978-9967':'Kyrgyz Republic','978-9968':'Costa Rica','978-9969':'Algeria','978-9970':'Uganda','978-9971':'Singapore','978-9972':'Peru','978-9973':'Tunisia','978-9974':'Uruguay','978-9975':'Moldova','978-9976':'Tanzania','978-9977':'Costa Rica','978-9978':'Ecuador','978-9979':'Iceland','978-9980':'Papua New Guinea','978-9981':'Morocco','978-9982':'Zambia','978-9983':'Gambia','978-9984':'Latvia','978-9985':'Estonia','978-9986':'Lithuania','978-9987':'Tanzania','978-9988':'Ghana','978-9989':'North Macedonia','978-99901':'Bahrain','978-99902':'Reserved Agency','978-99903':'Mauritius','978-99904':'Curaçao','978-99905':'Bolivia','978-99906':'Kuwait','978-99908':'Malawi','978-99909':'Malta','978-99910':'Sierra Leone','978-99911':'Lesotho','978-99912':'Botswana','978-99913':'Andorra','978-99914':'International NGO Publishers','978-99915':'Maldives','978-99916':'Namibia','978-99917':'Brunei Darussalam','978-99918':'Faroe Islands','978-99919':'Benin','978-99920':'Andorra','978-99921':'Qatar','978-99922':'Guatemala','978-99923':'El Salvador','978-99924':'Nicaragua','978-99925':'Paraguay','978-99926':'Honduras','978-99927':'Albania','978-99928':'Georgia','978-99929':'Mongolia','978-99930':'Armenia','978-99931':'Seychelles','978-99932':'Malta','978-99933':'Nepal','978-99934':'Dominican Republic','978-99935':'Haiti','978-99936':'Bhutan','978-99937':'Macau','978-99938':'Srpska, Republic of','978-99939':'Guatemala','978-99940':'Georgia','978-99941':'Armenia','978-99942':'Sudan','978-99943':'Albania','978-99944':'Ethiopia','978-99945':'Namibia','978-99946':'Nepal','978-99947':'Tajikistan','978-99948':'Eritrea','978-99949':'Mauritius','978-99950':'Cambodia','978-99951':'Reserved Agency','978-99952':'Mali','978-99953':'Paraguay','978-99954':'Bolivia','978-99955':'Srpska, Republic of','978-99956':'Albania','978-99957':'Malta','978-99958':'Bahrain','978-99959':'Luxembourg','978-99960':'Malawi','978-99961':'El Salvador','978-99962':'Mongolia','978-99963':'Cambodia','978-99964':'Nicaragua','978-99965':'Macau','978-99966':'Kuwait','978-99967':'Paraguay','978-99968':'Botswana','978-99969':'Oman','978-99970':'Haiti','978-99971':'Myanmar','978-99972':'Faroe Islands','978-99973':'Mongolia','978-99974':'Bolivia','978-99975':'Tajikistan','978-99976':'Srpska, Republic of','978-99977':'Rwanda','978-99978':'Mongolia','978-99979':'Honduras','978-99980':'Bhutan','978-99981':'Macau','978-99982':'Benin','978-99983':'El Salvador','978-99984':'Brunei Darussalam','978-99985':'Tajikistan','978-99986':'Myanmar','978-99987':'Luxembourg','978-99988':'Sudan','978-99989':'Paraguay','978-99990':'Ethiopia','978-99992':'Oman','978-99993':'Mauritius','979-10':'France','979-11':'Korea, Republic','979-12':'Italy','979-8':'United States'}
+
+
+def prefix_digits(prefix):
+    """Digits of a prefix like 978-2-07."""
+    return prefix.replace("-", "").strip()
+
+
+def prefix_range(prefix):
+    """First and last + 1 positions of the ISBNs under a prefix."""
+    digits = prefix_digits(prefix)
+    size = 10 ** (ISBN12_DIGITS - len(digits))
+    return int(digits) * size - ISBN12_OFFSET, (int(digits) + 1) * size - ISBN12_OFFSET
+
+
+class PrefixTable:
+    """Prefixes (with or without hyphens), matched by their index in the table."""
+
+    def __init__(self, prefixes):
+        self.prefixes = list(prefixes)
+        self.index = {}
+        for i, prefix in enumerate(self.prefixes):
+            self.index.setdefault(prefix_digits(prefix), i)
+        self.lengths = sorted({len(digits) for digits in self.index}, reverse=True)
+        self._keys = {}
+        for length in self.lengths:
+            items = sorted((int(digits), i) for digits, i in self.index.items() if len(digits) == length)
+            self._keys[length] = (
+                np.array([key for key, _ in items], dtype=np.int64),
+                np.array([i for _, i in items], dtype=np.int64),
+            )
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def match(self, isbn12, visible=None):
+        """
+        Index of the longest prefix of an ISBN12, or None. If given, visible
+        is a boolean sequence telling which prefixes may match.
+        """
+        digits = str(isbn12)
+        for length in self.lengths:
+            i = self.index.get(digits[:length])
+            if i is not None and (visible is None or visible[i]):
+                return i
+        return None
+
+    def match_array(self, isbn12s, visible=None):
+        """Vectorized match(): index of the longest prefix of each ISBN12, or -1."""
+        isbn12s = np.asarray(isbn12s, dtype=np.int64)
+        matches = np.full(isbn12s.shape, -1, dtype=np.int64)
+        for length in self.lengths:
+            keys, indices = self._keys[length]
+            pending = np.flatnonzero(matches == -1)
+            if not len(pending):
+                break
+            values = isbn12s.flat[pending] // 10 ** (ISBN12_DIGITS - length)
+            found = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+            hit = keys[found] == values
+            if visible is not None:
+                hit &= np.asarray(visible)[indices[found]]
+            matches.flat[pending[hit]] = indices[found[hit]]
+        return matches
+
+    def ranges(self):
+        """First and last + 1 positions of the ISBNs under each prefix."""
+        starts = np.zeros(len(self.prefixes), dtype=np.int64)
+        ends = np.zeros(len(self.prefixes), dtype=np.int64)
+        for length, (keys, indices) in self._keys.items():
+            size = 10 ** (ISBN12_DIGITS - length)
+            starts[indices] = keys * size - ISBN12_OFFSET
+            ends[indices] = (keys + 1) * size - ISBN12_OFFSET
+        return starts, ends
+
+    def parents(self):
+        """Index of the longest shorter prefix including each prefix, or -1."""
+        parents = np.full(len(self.prefixes), -1, dtype=np.int64)
+        for digits, i in self.index.items():
+            for length in self.lengths:
+                if length < len(digits) and digits[:length] in self.index:
+                    parents[i] = self.index[digits[:length]]
+                    break
+        return parents
+
+    def count(self, intervals):
+        """
+        Number of ISBNs of an IntervalSet whose longest matching prefix is
+        each prefix. Duplicated prefixes count for their first occurrence.
+        """
+        starts, ends = self.ranges()
+        counts = np.zeros(len(self.prefixes), dtype=np.int64)
+        canonical = np.array(sorted(self.index.values()), dtype=np.int64)
+        counts[canonical] = intervals.count_range(starts[canonical], ends[canonical])
+        parents = self.parents()
+        nested = np.flatnonzero(parents >= 0)
+        # Take the ISBNs of the nested prefixes out of their parent
+        inclusive = counts.copy()
+        np.subtract.at(counts, parents[nested], inclusive[nested])
+        return counts
+
+
+def country_table():
+    """PrefixTable of the registration groups of countries, names in the same order."""
+    return PrefixTable(countries), list(countries.values())
+
+
+def aggregate_publishers(records, max_prefix=6):
+    """
+    Stream the records into the registrants of each prefix of at most
+    max_prefix digits, in order of appearance, and the number of possible
+    books of each registrant. The columns are read RECORDS_CHUNK records at
+    a time and only the selected prefix entries become Python objects.
+    """
+    names = records.registrants.to_list()
+    if "Unknown" not in names:
+        names.append("Unknown")
+    unknown = names.index("Unknown")
+    names.append(None)
+    null = len(names) - 1
+    type_names = records.isbn_types.to_list()
+    prefix_type = type_names.index("prefix") if "prefix" in type_names else None
+    isbn13_type = type_names.index("isbn13") if "isbn13" in type_names else None
+
+    possible_books = np.zeros(len(names), dtype=np.int64)
+    prefix_registrants = {}
+    for first in tqdm.tqdm(range(0, len(records), RECORDS_CHUNK)):
+        last = min(first + RECORDS_CHUNK, len(records))
+        bounds = np.asarray(records.record_isbns[first:last + 1])
+        registrants = np.asarray(records.record_registrant[first:last]).astype(np.int64)
+        registrants[registrants == MISSING] = unknown
+        registrants[registrants == NULL] = null
+        isbn_type = np.asarray(records.isbn_type[bounds[0]:bounds[-1]])
+        isbn_length = np.asarray(records.isbn_length[bounds[0]:bounds[-1]]).astype(np.int64)
+        entries = np.arange(bounds[0], bounds[-1], dtype=np.int64)
+        entry_registrants = np.repeat(registrants, np.diff(bounds))
+
+        is_prefix = isbn_type == prefix_type if prefix_type is not None else np.zeros(len(entries), dtype=bool)
+        is_isbn13 = isbn_type == isbn13_type if isbn13_type is not None else np.zeros(len(entries), dtype=bool)
+        for entry in np.flatnonzero(~(is_prefix | is_isbn13)):
+            print(f"UNKNOWN ISBN TYPE !!! {type_names[isbn_type[entry]] if isbn_type[entry] >= 0 else None}")
+        # Each ISBN adds the possible books of the record's ISBNs up to it,
+        # i.e. the books of an ISBN are added once per ISBN from it to the
+        # end of its record
+        books = np.where(is_prefix, 10 ** np.maximum(12 - isbn_length, 0), is_isbn13.astype(np.int64))
+        record_ends = np.repeat(bounds[1:], np.diff(bounds))
+        np.add.at(possible_books, entry_registrants, books * (record_ends - entries))
+
+        # find prefixes <= max_prefix
+        selected = np.flatnonzero(is_prefix & (isbn_length <= max_prefix))
+        for entry, registrant in zip(entries[selected].tolist(), entry_registrants[selected].tolist()):
+            prefix = records.isbns[entry].replace("-", "")
+            prefix_registrants.setdefault(prefix, {})[registrant] = None
+
+    prefixes_data = {
+        prefix: [names[registrant] for registrant in registrants]
+        for prefix, registrants in prefix_registrants.items()
+    }
+    return prefixes_data, dict(zip(names, possible_books.tolist()))
+
+
+def select_registrant(registrants, possible_books):
+    """Registrant of a prefix shown on the map: the one with the most possible books."""
+    if len(registrants) > 1:
+        # TODO better heuristic to choose a single publisher to display...
+        return max(registrants, key=lambda x: possible_books[x])
+    return next(iter(registrants))
+
+
+def publisher_table(records, max_prefix=6):
+    """PrefixTable of the publisher prefixes of GroupRecords, and their selected registrant."""
+    prefixes_data, possible_books = aggregate_publishers(records, max_prefix)
+    registrants = [
+        select_registrant(set(registrant_names), possible_books)
+        for registrant_names in prefixes_data.values()
+    ]
+    return PrefixTable(prefixes_data), registrants
+
+
+def main():
+    args = docopt(__doc__)
+    tables = {"countries": country_table()}
+    if args["--publisher-file"]:
+        records = load_group_records(args["--publisher-file"])
+        tables["publishers"] = publisher_table(records, int(args["--max-prefix-len"]))
+    top = int(args["--top"])
+
+    results = {name: {} for name in tables}
+    for prefix, packed_isbns_binary in iter_packed_isbns(args["--input"]):
+        prefix = prefix.decode()
+        intervals = IntervalSet.from_packed(packed_isbns_binary)
+        for name, (table, labels) in tables.items():
+            counts = table.count(intervals)
+            results[name][prefix] = {
+                table.prefixes[i]: int(counts[i]) for i in np.flatnonzero(counts)
+            }
+        country_counts = results["countries"][prefix]
+        print(f"\n{prefix}: {intervals.count()} ISBNs, {sum(country_counts.values())} in a country prefix")
+        for country_prefix, count in sorted(country_counts.items(), key=lambda x: -x[1])[:top]:
+            print(f"    {country_prefix:12} {countries[country_prefix]:40} {count}")
+
+    if args["--output"]:
+        with open(args["--output"], "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Counts written to {args['--output']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""Columnar cache of the isbngrp_records jsonl.seekable.zst dump.
+
+The dump is parsed once into NumPy arrays saved next to it (by default in
+<file>.columns/) and memory-mapped on the next runs. The cache is rebuilt
+when the size or modification time of the source file changes.
+
+Strings (registrant, country, agency names, isbn types) are interned in
+tables and referenced by id, MISSING (-1) when the key is absent from the
+record and NULL (-2) when its value is null. The ISBNs of record i are the
+entries record_isbns[i] to record_isbns[i + 1] of the isbn_* columns.
+
+The ISBN entries of type prefix are also indexed by their digits
+(prefix_entries sorted by prefix_digits), to find the records of a prefix or
+the prefixes under another one with a binary search.
+
+Seekable dumps can be parsed by several processes, one per range of zstd
+frames, whose partial columns are merged in file order.
+"""
+
+import functools
+import json
+import os
+import shutil
+
+import numpy as np
+import tqdm
+
+from seekable_zstd import map_lines
+
+CACHE_VERSION = 2
+MISSING = -1
+NULL = -2
+
+STRING_TABLES = ["registrants", "countries", "agencies", "isbn_types", "isbns"]
+COLUMNS = [
+    "record_registrant",
+    "record_country",
+    "record_agency",
+    "record_isbns",
+    "isbn_type",
+    "isbn_length",
+]
+INDEX_COLUMNS = ["prefix_entries", "prefix_digits"]
+# String table referenced by each id column
+COLUMN_TABLES = {
+    "record_registrant": "registrants",
+    "record_country": "countries",
+    "record_agency": "agencies",
+    "isbn_type": "isbn_types",
+}
+
+
+def normalize_prefix(prefix):
+    """Digits of an ISBN prefix, without its hyphens."""
+    return prefix.replace("-", "").strip()
+
+
+class StringTable:
+    """Strings stored as one utf-8 blob and their offsets in it."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    def to_list(self):
+        data = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        return [data[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+class _Interner:
+    def __init__(self):
+        self.ids = {}
+
+    def get(self, record, key):
+        if key not in record:
+            return MISSING
+        value = record[key]
+        if value is None:
+            return NULL
+        return self.ids.setdefault(value, len(self.ids))
+
+    def strings(self):
+        return list(self.ids)
+
+
+class ColumnsBuilder:
+    """Accumulate records (the metadata.record objects) into columns."""
+
+    def __init__(self):
+        self.interners = {name: _Interner() for name in STRING_TABLES if name != "isbns"}
+        self.isbns = []
+        self.columns = {name: [] for name in COLUMNS}
+        self.columns["record_isbns"].append(0)
+
+    def add(self, record_data):
+        registrant = self.interners["registrants"].get(record_data, "registrant_name")
+        country = self.interners["countries"].get(record_data, "country_name")
+        agency = self.interners["agencies"].get(record_data, "agency_name")
+        isbns = [isbn.get("isbn") or "" for isbn in record_data.get("isbns", [])]
+        isbn_types = [
+            self.interners["isbn_types"].get(isbn, "isbn_type") for isbn in record_data.get("isbns", [])
+        ]
+
+        columns = self.columns
+        columns["record_registrant"].append(registrant)
+        columns["record_country"].append(country)
+        columns["record_agency"].append(agency)
+        self.isbns.extend(isbns)
+        columns["isbn_type"].extend(isbn_types)
+        columns["isbn_length"].extend(len(isbn.replace("-", "")) for isbn in isbns)
+        columns["record_isbns"].append(len(self.isbns))
+
+    def add_line(self, line):
+        """Parse one jsonl line, skipping invalid ones like the readers used to."""
+        try:
+            record = json.loads(line)
+            self.add(record.get("metadata", {}).get("record", {}))
+        except json.JSONDecodeError:
+            pass
+        except Exception as e:
+            print(f"Error processing line: {e}")
+
+    def merge(self, other):
+        """Append the records of another builder, renumbering its string ids."""
+        mappings = {
+            name: [self.interners[name].ids.setdefault(s, len(self.interners[name].ids)) for s in strings]
+            for name, strings in ((name, i.strings()) for name, i in other.interners.items())
+        }
+        for name, table in COLUMN_TABLES.items():
+            mapping = mappings[table]
+            self.columns[name].extend(v if v < 0 else mapping[v] for v in other.columns[name])
+        self.columns["isbn_length"].extend(other.columns["isbn_length"])
+        offset = len(self.isbns)
+        self.columns["record_isbns"].extend(offset + v for v in other.columns["record_isbns"][1:])
+        self.isbns.extend(other.isbns)
+
+    def save(self, cache_dir):
+        os.makedirs(cache_dir)
+        tables = {name: StringTable.from_strings(i.strings()) for name, i in self.interners.items()}
+        tables["isbns"] = StringTable.from_strings(self.isbns)
+        for name, table in tables.items():
+            np.save(f"{cache_dir}/{name}_blob.npy", table.blob)
+            np.save(f"{cache_dir}/{name}_offsets.npy", table.offsets)
+        dtypes = {"record_isbns": np.int64, "isbn_type": np.int16, "isbn_length": np.uint8}
+        for name, values in self.columns.items():
+            np.save(f"{cache_dir}/{name}.npy", np.array(values, dtype=dtypes.get(name, np.int32)))
+
+
+class GroupRecords:
+    """Memory-mapped columns of a cache directory."""
+
+    def __init__(self, cache_dir, index=True):
+        for name in STRING_TABLES:
+            setattr(
+                self,
+                name,
+                StringTable(
+                    np.load(f"{cache_dir}/{name}_blob.npy", mmap_mode="r"),
+                    np.load(f"{cache_dir}/{name}_offsets.npy", mmap_mode="r"),
+                ),
+            )
+        for name in COLUMNS + (INDEX_COLUMNS if index else []):
+            setattr(self, name, np.load(f"{cache_dir}/{name}.npy", mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.record_registrant)
+
+    def record(self, index):
+        """Record index, as a dict like the ones of iter_records()."""
+        record = {}
+        for key, ids, strings in (
+            ("registrant_name", self.record_registrant, self.registrants),
+            ("country_name", self.record_country, self.countries),
+            ("agency_name", self.record_agency, self.agencies),
+        ):
+            if ids[index] != MISSING:
+                record[key] = strings[ids[index]] if ids[index] != NULL else None
+        record["isbns"] = [
+            {
+                "isbn": self.isbns[entry],
+                "isbn_type": self.isbn_types[self.isbn_type[entry]] if self.isbn_type[entry] >= 0 else None,
+            }
+            for entry in range(self.record_isbns[index], self.record_isbns[index + 1])
+        ]
+        return record
+
+    def _prefix_entries(self, prefix, subtree):
+        digits = normalize_prefix(prefix).encode()
+        start = np.searchsorted(self.prefix_digits, digits, "left")
+        if subtree:
+            end = np.searchsorted(self.prefix_digits, digits + b"\xff", "left")
+        else:
+            end = np.searchsorted(self.prefix_digits, digits, "right")
+        return self.prefix_entries[start:end].tolist()
+
+    def find_prefix(self, prefix):
+        """Indices of the records having prefix as an ISBN of type prefix."""
+        entries = [e for e in self._prefix_entries(prefix, False) if self.isbns[e] == prefix]
+        return np.unique(np.searchsorted(self.record_isbns, entries, "right") - 1).tolist()
+
+    def prefixes_under(self, prefix):
+        """Distinct ISBN prefixes starting with the digits of prefix, sorted by digits."""
+        return list(dict.fromkeys(self.isbns[e] for e in self._prefix_entries(prefix, True)))
+
+    def iter_records(self):
+        """
+        Yield the records as the dicts found under metadata.record in the
+        dump, restricted to the cached keys.
+        """
+        keys = [
+            ("registrant_name", self.record_registrant.tolist(), self.registrants.to_list()),
+            ("country_name", self.record_country.tolist(), self.countries.to_list()),
+            ("agency_name", self.record_agency.tolist(), self.agencies.to_list()),
+        ]
+        isbns = self.isbns.to_list()
+        isbn_types = self.isbn_types.to_list()
+        isbn_type = self.isbn_type.tolist()
+        record_isbns = self.record_isbns.tolist()
+        for index in range(len(self)):
+            record = {}
+            for key, ids, strings in keys:
+                if ids[index] != MISSING:
+                    record[key] = strings[ids[index]] if ids[index] != NULL else None
+            record["isbns"] = [
+                {
+                    "isbn": isbns[entry],
+                    "isbn_type": isbn_types[isbn_type[entry]] if isbn_type[entry] >= 0 else None,
+                }
+                for entry in range(record_isbns[index], record_isbns[index + 1])
+            ]
+            yield record
+
+
+def save_prefix_index(records, cache_dir):
+    """Index the ISBN entries of type prefix of records by their digits."""
+    isbn_types = records.isbn_types.to_list()
+    if "prefix" in isbn_types:
+        entries = np.flatnonzero(np.asarray(records.isbn_type) == isbn_types.index("prefix"))
+    else:
+        entries = np.zeros(0, dtype=np.int64)
+    isbns = records.isbns.to_list()
+    digits = [normalize_prefix(isbns[e]).encode() for e in entries.tolist()]
+    order = sorted(range(len(entries)), key=lambda i: (digits[i], isbns[entries[i]]))
+    np.save(f"{cache_dir}/prefix_entries.npy", entries[order].astype(np.int64))
+    np.save(f"{cache_dir}/prefix_digits.npy", np.array([digits[i] for i in order], dtype=bytes))
+
+
+def _source_stamp(file_path):
+    stat = os.stat(file_path)
+    return {"version": CACHE_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _build_columns(lines, progress=False):
+    builder = ColumnsBuilder()
+    for line in tqdm.tqdm(lines, disable=not progress):
+        builder.add_line(line)
+    return builder
+
+
+def build_cache(file_path, cache_dir, jobs=1):
+    """Parse the whole dump into cache_dir, with jobs processes if seekable."""
+    partials = map_lines(file_path, functools.partial(_build_columns, progress=jobs == 1), jobs)
+    builder = partials[0]
+    for partial in tqdm.tqdm(partials[1:], disable=len(partials) == 1):
+        builder.merge(partial)
+
+    tmp_dir = f"{cache_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    builder.save(tmp_dir)
+    save_prefix_index(GroupRecords(tmp_dir, index=False), tmp_dir)
+    with open(f"{tmp_dir}/source.json", "w") as f:
+        json.dump(_source_stamp(file_path), f)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(tmp_dir, cache_dir)
+
+
+def load_group_records(file_path, cache_dir=None, jobs=1):
+    """
+    Return the GroupRecords of the dump, building or rebuilding its cache
+    first if needed.
+    """
+    if cache_dir is None:
+        cache_dir = f"{file_path}.columns"
+    try:
+        with open(f"{cache_dir}/source.json") as f:
+            up_to_date = json.load(f) == _source_stamp(file_path)
+    except (OSError, ValueError):
+        up_to_date = False
+    if not up_to_date:
+        print(f"Building columnar cache {cache_dir} of {file_path}...")
+        build_cache(file_path, cache_dir, jobs)
+    return GroupRecords(cache_dir)
@@ -0,0 +1,108 @@
+"""Generate the LD and HD images in a single pass over the dump.
+
+Does the work of make_isbn_images_fractal_cluster.py (LD density images,
+numpy engine) and make_isbn_images_fractal.py (HD black and white images,
+band engine, each process staying within --memory), reading and decoding
+the dump once: each prefix is decoded to
+intervals a single time, its decoded runs are handed to the process
+rendering all of its images, and the union used by the combined images is
+shared by both outputs.
+
+With --cache, the images are shared with the same engines of both scripts
+in the render cache: only the images of changed prefixes are rendered.
+
+Usage:
+    make_isbn_images.py [options]
+
+Options:
+    -i --input=<file>       Input filename [default: aa_isbn13_codes_20241204T185335Z.benc.zst]
+    -o --output=<dir>       Output directory [default: images_tmp]
+    --outputs=<list>        Comma separated outputs: ld, hd [default: ld,hd]
+    --ld-suffix=<suffix>    Filename suffix of the LD images [default: _cluster]
+    --hd-suffix=<suffix>    Filename suffix of the HD images [default: _hd]
+    -m --memory=<mb>        Memory budget of the HD band engine, in MB [default: 1024]
+    -j --jobs=<n>           Number of processes rendering prefixes [default: 1]
+    --cache=<dir>           Render cache directory, none by default
+    --cache-size=<mb>       Size limit of the render cache, in MB [default: 10240]
+    -h --help               Show this help message
+
+Example:
+    python make_isbn_images.py -o images_tmp -j 4
+"""
+
+import os
+import sys
+
+from docopt import docopt
+
+import make_isbn_images_fractal
+import make_isbn_images_fractal_cluster
+from benc_stream import iter_packed_isbns
+from isbn_intervals import IntervalSet
+from isbn_parallel import render_dump
+from render_cache import open_cache
+
+RENDERERS = {
+    "ld": make_isbn_images_fractal_cluster,
+    "hd": make_isbn_images_fractal,
+}
+# Engine of the renderers, in the render cache keys
+ENGINES = {
+    "ld": "numpy",
+    "hd": "band",
+}
+MB = 1 << 20
+
+
+def render_image(output, filename, sets, memory):
+    """Render the image of an IntervalSet, or the combined one of (all ISBNs, md5 ISBNs)."""
+    if output == "hd":
+        make_isbn_images_fractal.write_band_image(filename, sets, memory)
+    elif len(sets) == 1:
+        make_isbn_images_fractal_cluster.prefix_image(sets[0]).save(filename)
+    else:
+        make_isbn_images_fractal_cluster.all_image(*sets).save(filename)
+
+
+def render_prefix_images(runs, images, memory):
+    """Render the images [(output, filename)] of the decoded runs of a prefix."""
+    intervals = IntervalSet.from_bytes(runs)
+    for output, filename in images:
+        print(f"Generating {filename}...")
+        render_image(output, filename, [intervals], memory)
+
+
+def main():
+    args = docopt(__doc__)
+    input_filename = args["--input"]
+    output_dir = args["--output"]
+    jobs = int(args["--jobs"])
+    outputs = args["--outputs"].split(",")
+    if any(output not in RENDERERS for output in outputs):
+        print(f"Unknown output in {args['--outputs']}, use {', '.join(RENDERERS)}")
+        sys.exit(1)
+    suffixes = {"ld": args["--ld-suffix"], "hd": args["--hd-suffix"]}
+    memory = int(args["--memory"]) * MB
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    def submit(pool, packed_isbns_binary, intervals, images):
+        pool.submit(render_prefix_images, intervals.to_bytes(), images, memory)
+
+    def render_all(output, filename, all_isbns, md5_isbns):
+        render_image(output, filename, [all_isbns, md5_isbns], memory)
+
+    render_dump(
+        iter_packed_isbns(input_filename),
+        output_dir,
+        {output: (suffixes[output], (ENGINES[output], *RENDERERS[output].CACHE_OPTIONS)) for output in outputs},
+        submit,
+        render_all,
+        jobs,
+        open_cache(args["--cache"], args["--cache-size"]),
+    )
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
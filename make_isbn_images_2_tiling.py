@@ -1,5 +1,8 @@
 """Generate ISBN images with tiled layout.
 
+With --cache, the tiles of an image whose content was already tiled with
+the same options are copied from the render cache instead of being cut.
+
 Usage:
     make_isbn_images_2_tiling.py [options]
 
@@ -10,14 +13,19 @@ Options:
     -m --overlap=<n>        Overlap size around tiles [default: 0]
     -d --depth=<depth>      Pyramid depth : onetile, onepixel, one [default: onetile]
     -o --output=<dir>       Output directory [default: images]
-    -r --resize=<n>         Resize factor (power of 2) [default: 1]
+    -r --resize=<list>      Comma separated resize factors (powers of 2) [default: 1]
     -v --move-dir=<dir>     Move directory for depth=one [default: none]
     -p --move-suffix=<move> Move to directory with suffix
+    --report=<file>         Write a JSON report of the time spent in each stage
+    --profile=<stage>       Profile a stage (load, dzsave) with cProfile
+    --cache=<dir>           Render cache directory, none by default
+    --cache-size=<mb>       Size limit of the render cache, in MB [default: 10240]
     -h --help            Show this help message
 
 Example:
     python make_isbn_images_2_tiling.py
     python make_isbn_images_2_tiling.py -i myimages -s png -t 40 -m 5 -d onepixel -o output
+    python make_isbn_images_2_tiling.py -d one -r 1,2,4,8 -v ../isbn_images_data/images -p ''
 """
 
 import sys
@@ -26,6 +34,8 @@ import pyvips
 from docopt import docopt
 from pathlib import Path
 import shutil
+from render_cache import cache_key, file_digest, open_cache
+from run_report import RunReport, directory_size, stage
 
 def get_next_directory_number(move_dir):
     """Get the next available number for the directory"""
@@ -35,15 +45,40 @@ def get_next_directory_number(move_dir):
     return max(existing_dirs + [-1]) + 1
 
 
-def create_pyramid(input_dir, input_suffix, tile_size, overlap, depth, resize, output_dir, move_dir, move_suffix):
+def save_level(image, tile_size, overlap, out_move_dir, level):
+    """
+    Save a single level (depth=one) pyramid straight to out_move_dir/level,
+    dzsave output being renamed in place instead of moved across directories.
+    """
+    output_path = f"{out_move_dir}/.level_{level}_t"
+    image.dzsave(output_path,
+                tile_size=tile_size,
+                depth="one",
+                overlap=overlap,
+                region_shrink= pyvips.enums.RegionShrink.NEAREST,
+                suffix='.png')
+    target_dir = os.path.join(out_move_dir, str(level))
+    os.rename(f"{output_path}_files/0", target_dir)
+    os.remove(f"{output_path}.dzi")
+    shutil.rmtree(f"{output_path}_files")
+    print(f"Created level at: {target_dir}")
+    return target_dir
+
+
+def create_pyramid(input_dir, input_suffix, tile_size, overlap, depth, resizes, output_dir, move_dir, move_suffix, report=None, cache=None):
     """
     Create pyramids for all images with given suffix in the input directory.
     The pyramids will be created in the same directory.
+    Each input image is decoded once and reused for every resize factor,
+    and only when some of its tiles are not found in the render cache.
 
     Args:
         input_dir (str): Directory containing the input images
         input_suffix (str): Suffix of input files (e.g., '_isbns_cluster')
+        resizes (list): Resize factors, one pyramid (or level for depth=one) each
         output_dir (str): Directory where pyramids will be created
+        report (RunReport): Records the load and dzsave stages of each file
+        cache (RenderCache): Cache of the tiles, keyed by the image content
     """
     
     # Convert input_dir to Path object
@@ -69,54 +104,81 @@ def create_pyramid(input_dir, input_suffix, tile_size, overlap, depth, resize, o
     # Process each file
     for input_file in input_files:
         try:
-            # Create output name (same as input but with _t suffix)
-            output_base = input_file.stem + '_t'
-            output_path = Path(output_dir) / output_base
-
             print(f"\nProcessing: {input_file.name}")
-
-            # Load image
-            image = pyvips.Image.new_from_file(str(input_file))
-            
-            # Resize image if needed
-            
-            if resize > 1:
-                # doing it with vips, I can't find the right way to double each pixel
-                #image = image.resize(resize, kernel=pyvips.enums.Kernel.NEAREST)
-                image = image.affine([resize, 0, 0, resize], interpolate=pyvips.Interpolate.new('nearest'))
-
-            # Get image dimensions
-            width = image.width
-            height = image.height
-            print(f"Image dimensions: {width}x{height}")
-
-            # Create pyramid with default settings
-            # Using DeepZoom format, tile size 256, and onetile depth
-            image.dzsave(str(output_path),
-                        tile_size=tile_size,
-                        depth=depth,
-                        overlap=overlap,
-                        region_shrink= pyvips.enums.RegionShrink.NEAREST,
-                        suffix='.png')
-
-            print(f"Created pyramid at: {output_path}_files/")
-            print(f"Metadata file at: {output_path}.dzi")
-            os.remove(f"{output_path}.dzi")
-            os.remove(f"{output_path}_files/vips-properties.xml")
-
-            if depth == "one" and move_dir != "none":
-                source_dir = f"{output_path}_files/0"
-                out_move_dir = f"{move_dir}/{input_file.stem}{move_suffix}_t_files"
-                os.makedirs(out_move_dir, exist_ok=True)
-                if os.path.exists(source_dir) and os.path.exists(out_move_dir):
-                    next_num = get_next_directory_number(out_move_dir)
-                    target_dir = os.path.join(out_move_dir, str(next_num))
-                    shutil.move(source_dir, target_dir)
-                    print(f"Moved {source_dir} to {target_dir}")
-                    # Clean up empty directory
-                    shutil.rmtree(f"{output_path}_files")
-                else:
-                    print(f"Cannot move {source_dir} to {out_move_dir} as one of them does not exist")
+            digest = None if cache is None else file_digest(input_file)
+            source_image = None
+
+            for resize in resizes:
+                key = None
+                if cache is not None:
+                    # Same directories as the ones written below
+                    moved = depth == "one" and move_dir != "none"
+                    key = cache_key(digest, "pyramid", tile_size, overlap, depth, resize, moved)
+                    if moved:
+                        out_move_dir = f"{move_dir}/{input_file.stem}{move_suffix}_t_files"
+                        tiles_dir = os.path.join(out_move_dir, str(get_next_directory_number(out_move_dir)))
+                    else:
+                        output_base = input_file.stem + '_t'
+                        if len(resizes) > 1:
+                            output_base = f"{input_file.stem}_r{resize}_t"
+                        tiles_dir = f"{Path(output_dir) / output_base}_files"
+                    if cache.restore(key, tiles_dir):
+                        print(f"Restored {tiles_dir} from the cache")
+                        continue
+
+                # Load image once for every level: vips decodes it on first use,
+                # large images to a temporary file rather than to memory
+                if source_image is None:
+                    with stage(report, "load", input_file.name) as load:
+                        source_image = pyvips.Image.new_from_file(str(input_file))
+                        load["bytes_read"] = input_file.stat().st_size
+
+                image = source_image
+                # Resize image if needed
+                if resize > 1:
+                    # doing it with vips, I can't find the right way to double each pixel
+                    #image = image.resize(resize, kernel=pyvips.enums.Kernel.NEAREST)
+                    image = image.affine([resize, 0, 0, resize], interpolate=pyvips.Interpolate.new('nearest'))
+
+                # Get image dimensions
+                width = image.width
+                height = image.height
+                print(f"Image dimensions: {width}x{height}")
+
+                # The resize is computed by vips while the tiles are saved
+                if depth == "one" and move_dir != "none":
+                    out_move_dir = f"{move_dir}/{input_file.stem}{move_suffix}_t_files"
+                    os.makedirs(out_move_dir, exist_ok=True)
+                    with stage(report, "dzsave", f"{input_file.name} x{resize}") as save:
+                        target_dir = save_level(image, tile_size, overlap, out_move_dir, get_next_directory_number(out_move_dir))
+                        save["items"], save["bytes_written"] = directory_size(target_dir)
+                    if key is not None:
+                        cache.store(key, target_dir)
+                    continue
+
+                # Create output name (same as input but with _t suffix)
+                output_base = input_file.stem + '_t'
+                if len(resizes) > 1:
+                    output_base = f"{input_file.stem}_r{resize}_t"
+                output_path = Path(output_dir) / output_base
+
+                # Create pyramid with default settings
+                # Using DeepZoom format, tile size 256, and onetile depth
+                with stage(report, "dzsave", f"{input_file.name} x{resize}") as save:
+                    image.dzsave(str(output_path),
+                                tile_size=tile_size,
+                                depth=depth,
+                                overlap=overlap,
+                                region_shrink= pyvips.enums.RegionShrink.NEAREST,
+                                suffix='.png')
+
+                    print(f"Created pyramid at: {output_path}_files/")
+                    print(f"Metadata file at: {output_path}.dzi")
+                    os.remove(f"{output_path}.dzi")
+                    os.remove(f"{output_path}_files/vips-properties.xml")
+                    save["items"], save["bytes_written"] = directory_size(f"{output_path}_files")
+                if key is not None:
+                    cache.store(key, f"{output_path}_files")
 
         except Exception as e:
             print(f"Error processing {input_file.name}: {str(e)}")
@@ -128,17 +190,22 @@ def main():
     tile_size = int(args['--tile-size'])
     overlap = int(args['--overlap'])
     depth = args['--depth']
-    resize = int(args['--resize'])
+    resizes = [int(r) for r in args['--resize'].split(',')]
     output_dir = args['--output']
     move_dir = args['--move-dir']
     move_suffix = args['--move-suffix']
 
-    # Validate resize is a power of 2
-    if resize & (resize - 1) != 0:
+    # Validate resize factors are powers of 2
+    if any(resize < 1 or resize & (resize - 1) != 0 for resize in resizes):
         print("Error: resize factor must be a power of 2")
         sys.exit(1)
 
-    create_pyramid(input_dir, input_suffix, tile_size, overlap, depth, resize, output_dir, move_dir, move_suffix)
+    report = RunReport(args['--profile'])
+    cache = open_cache(args['--cache'], args['--cache-size'])
+    create_pyramid(input_dir, input_suffix, tile_size, overlap, depth, resizes, output_dir, move_dir, move_suffix, report, cache)
+    if cache is not None:
+        cache.print_stats()
+    report.finish(args['--report'])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
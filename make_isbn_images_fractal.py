@@ -1,5 +1,12 @@
 """Generate ISBN fractal images.
 
+The band engine renders the image a band of rows at a time and streams the
+rows to the PNG file, so each process stays within --memory instead of
+holding the whole canvas.
+
+With --cache, images of prefixes whose packed ISBNs were already rendered
+with the same engine are copied from the render cache.
+
 Usage:
     make_isbn_images_fractal.py [options]
 
@@ -7,17 +14,30 @@ Options:
     -i --input=<file>     Input filename [default: aa_isbn13_codes_20241204T185335Z.benc.zst]
     -x --suffix=<suffix>  Output filename suffix [default: _isbns]
     -o --output=<dir>     Output directory [default: images_tmp]
+    -e --engine=<engine>  Rendering engine: pixel, numpy or band [default: pixel]
+    -m --memory=<mb>      Memory budget of the band engine, in MB [default: 1024]
+    -j --jobs=<n>         Number of processes rendering prefixes [default: 1]
+    --report=<file>       Write a JSON report of the time spent in each stage
+    --profile=<stage>     Profile a stage (read, union, decode, render, encode) with cProfile
+    --cache=<dir>         Render cache directory, none by default
+    --cache-size=<mb>     Size limit of the render cache, in MB [default: 10240]
     -h --help            Show this help message
 """
 
-import bencodepy
+import numpy as np
 import PIL.Image
 import PIL.ImageChops
 import struct
 import tqdm
-import zstandard
 from docopt import docopt
 import os
+from benc_stream import iter_packed_isbns
+from isbn_intervals import IntervalSet, count_isbns, iter_positions
+from isbn_layout import Layout
+from isbn_parallel import render_dump
+from png_stream import PNGWriter
+from render_cache import open_cache
+from run_report import RunReport, prefix_fields
 
 
 WIDTH = 50000
@@ -35,55 +55,28 @@ VECTOR = [
     HEIGHT // (2 * 10000),
 ]
 
+# A block of BLOCK_WIDTH x BLOCK_HEIGHT pixels holds consecutive positions
+BLOCK_WIDTH = VECTOR[3]
+BLOCK_HEIGHT = VECTOR[4]
+# Peak bytes of a band pixel (RGB band, mask and PNG rows) and of a position
+# being rasterized (positions, digit indices and coordinates)
+BAND_BYTES_PER_PIXEL = 8
+BYTES_PER_POSITION = 64
+MB = 1 << 20
 
-def get_recursive_xy(position):
-    coords = [0, 0]  # [x, y]
-    isbn_str = str(position).zfill(LEN_SHORT_ISBN)
-    # Process remaining digits
-    for i in range(LEN_SHORT_ISBN - 1):
-        digit = int(isbn_str[i])
-        coords[(i + 1) % 2] += digit * VECTOR[i]
+LAYOUT = Layout(WIDTH, HEIGHT, VECTOR, tail_width=5)
+# Layout of the HD images, in their render cache keys
+CACHE_OPTIONS = ("fractal", WIDTH, HEIGHT, tuple(VECTOR))
 
-    digit = int(isbn_str[LEN_SHORT_ISBN - 1])
-    last_y = digit // 5
 
-    coords[0] += digit %5
-    coords[1] += last_y
-    return coords[0], coords[1]
+def get_recursive_xy(position):
+    return LAYOUT.get_xy(position)
 
 def find_isbn_from_xy(x, y):
-    # Initialize ISBN digits
-    isbn_digits = [0] * LEN_SHORT_ISBN
-
-    remaining_x = x
-    remaining_y = y
-
-    # Process all digits except the last one
-    for i in range(LEN_SHORT_ISBN - 1):
-        if (i + 1) % 2 == 0:  # x coordinate
-            digit = remaining_x // VECTOR[i]
-            remaining_x = remaining_x % VECTOR[i]
-        else:  # y coordinate
-            digit = remaining_y // VECTOR[i]
-            remaining_y = remaining_y % VECTOR[i]
-
-        if 0 <= digit <= 9:
-            isbn_digits[i] = digit
-        else:
-            return None  # Invalid coordinates
-
-    # Handle the last digit specially
-    # The last digit needs to satisfy both:
-    # digit % 5 = remaining_x
-    # digit // 5 = remaining_y
-    last_digit = (remaining_y * 5) + remaining_x
-
-    if 0 <= last_digit <= 9:
-        isbn_digits[LEN_SHORT_ISBN - 1] = last_digit
-        isbn = int(''.join(map(str, isbn_digits)))
-        return 978000000000 + isbn
-
-    return None  # If no valid solution is found
+    position = LAYOUT.find_position(x, y)
+    if position is None:
+        return None  # Invalid coordinates
+    return 978000000000 + position
 
 def color_image(
     image, packed_isbns_binary, color=None, addcolor=None, unique_isbns=None
@@ -133,49 +126,199 @@ def color_image(
         isbn_streak = not isbn_streak
 
 
+def color_array(array, intervals, value):
+    """
+    Batched version of color_image: set array[y, x] = value for every ISBN of
+    the IntervalSet, a whole chunk of positions at a time.
+    For a bit-packed "1" raster (uint8 array of WIDTH // 8 columns), pass
+    value=None to set the bits instead.
+    """
+    width = array.shape[1] * 8 if value is None else array.shape[1]
+    height = array.shape[0]
+    out_of_image = 0
+    for positions in tqdm.tqdm(iter_positions(intervals.starts, intervals.ends)):
+        xs, ys = LAYOUT.get_xy(positions)
+        inside = (xs < width) & (ys < height)
+        out_of_image += len(positions) - np.count_nonzero(inside)
+        xs = xs[inside]
+        ys = ys[inside]
+        if value is None:
+            np.bitwise_or.at(
+                array, (ys, xs >> 3), (0x80 >> (xs & 7)).astype(np.uint8)
+            )
+        else:
+            array[ys, xs] = value
+    if out_of_image:
+        print(f"{out_of_image} pixels out of image!!!")
+
+
+def new_bit_array():
+    return np.zeros((HEIGHT, WIDTH // 8), dtype=np.uint8)
+
+
+def bit_array_to_image(array):
+    return PIL.Image.frombytes("1", (WIDTH, HEIGHT), array.tobytes())
+
+
+def prefix_image(intervals):
+    """Black and white image of the ISBNs of an IntervalSet (numpy engine)."""
+    prefix_isbns_array = new_bit_array()
+    color_array(prefix_isbns_array, intervals, None)
+    return bit_array_to_image(prefix_isbns_array)
+
+
+def all_image(all_isbns, md5_isbns):
+    """Combined image, md5 ISBNs in green and the others in red (numpy engine)."""
+    all_isbns_array = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    color_array(all_isbns_array[:, :, 0], all_isbns, 255)
+    color_array(all_isbns_array[:, :, 1], md5_isbns, 255)
+    return PIL.Image.fromarray(all_isbns_array)
+
+
+def band_sizes(memory):
+    """
+    Rows of a band (a multiple of BLOCK_HEIGHT) and positions rasterized at
+    a time, half of memory bytes going to each.
+    """
+    blocks = memory // 2 // (BLOCK_HEIGHT * WIDTH * BAND_BYTES_PER_PIXEL)
+    rows = min(max(blocks, 1) * BLOCK_HEIGHT, HEIGHT)
+    return rows, max(memory // 2 // BYTES_PER_POSITION, 1)
+
+
+def band_intervals(intervals, y0, y1):
+    """Runs of the IntervalSet laid out in the rows [y0, y1) of blocks."""
+    xs = np.arange(0, WIDTH, BLOCK_WIDTH)
+    ys = np.arange(y0, y1, BLOCK_HEIGHT)
+    starts = LAYOUT.find_position(xs[None, :], ys[:, None]).ravel()
+    return intervals.clip(starts, starts + BLOCK_WIDTH * BLOCK_HEIGHT)
+
+
+def band_mask(intervals, y0, y1, chunk_size):
+    """Boolean mask of the rows [y0, y1) telling which pixels are in the IntervalSet."""
+    mask = np.zeros((y1 - y0, WIDTH), dtype=bool)
+    selected = band_intervals(intervals, y0, y1)
+    for positions in iter_positions(selected.starts, selected.ends, chunk_size):
+        xs, ys = LAYOUT.get_xy(positions)
+        mask[ys - y0, xs] = True
+    return mask
+
+
+def write_band_image(filename, sets, memory):
+    """
+    Stream the black and white image of a single IntervalSet, or the red/green
+    combined image of (all ISBNs, md5 ISBNs), to filename one band at a time.
+    Only the runs laid out in a band are rasterized with it.
+    """
+    rows, chunk_size = band_sizes(memory)
+    mode = "1" if len(sets) == 1 else "RGB"
+    with PNGWriter(filename, WIDTH, HEIGHT, mode) as png:
+        for y0 in tqdm.tqdm(range(0, HEIGHT, rows)):
+            y1 = min(y0 + rows, HEIGHT)
+            if len(sets) == 1:
+                png.write(band_mask(sets[0], y0, y1, chunk_size))
+                continue
+            band = np.zeros((y1 - y0, WIDTH, 3), dtype=np.uint8)
+            for channel, intervals in enumerate(sets):
+                band[:, :, channel][band_mask(intervals, y0, y1, chunk_size)] = 255
+            png.write(band)
+
+
+def render_prefix_image(packed_isbns_binary, filename, engine, memory, profile_stage=None):
+    """Render and save the image of a prefix, returning the stages of its RunReport."""
+    print(f"Generating {filename}...")
+    report = RunReport(profile_stage)
+    name = os.path.basename(filename)
+    if engine in ("numpy", "band"):
+        with report.stage("decode", name) as stage:
+            intervals = IntervalSet.from_packed(packed_isbns_binary)
+            stage["items"] = intervals.count()
+            stage["bytes_read"] = len(packed_isbns_binary)
+    if engine == "band":
+        with report.stage("render", name) as stage:
+            write_band_image(filename, [intervals], memory)
+            stage["items"] = intervals.count()
+            stage["bytes_written"] = os.path.getsize(filename)
+        return report.worker_result()
+    with report.stage("render", name) as stage:
+        if engine == "numpy":
+            prefix_isbns_png = prefix_image(intervals)
+            stage["items"] = intervals.count()
+        else:
+            prefix_isbns_png = PIL.Image.new("1", (WIDTH, HEIGHT), 0)
+            color_image(prefix_isbns_png, packed_isbns_binary, color=1)
+            stage["items"] = count_isbns(packed_isbns_binary)
+    with report.stage("encode", name) as stage:
+        prefix_isbns_png.save(filename)
+        stage["bytes_written"] = os.path.getsize(filename)
+    return report.worker_result()
+
+
+def render_all_image(filename, all_isbns, md5_isbns, engine, memory, report):
+    """Render and save the combined image, md5 ISBNs in green and the others in red."""
+    if engine == "band":
+        with report.stage("render", os.path.basename(filename)) as stage:
+            write_band_image(filename, [all_isbns, md5_isbns], memory)
+            stage["items"] = all_isbns.count() + md5_isbns.count()
+            stage["bytes_written"] = os.path.getsize(filename)
+        return
+    with report.stage("render", os.path.basename(filename)) as stage:
+        stage["items"] = all_isbns.count() + md5_isbns.count()
+        if engine == "numpy":
+            all_isbns_png = all_image(all_isbns, md5_isbns)
+        else:
+            all_isbns_png = PIL.Image.new("RGB", (WIDTH, HEIGHT), (0, 0, 0))
+            color_image(
+                all_isbns_png, (all_isbns - md5_isbns).to_packed(), color=(255, 0, 0)
+            )
+            color_image(
+                all_isbns_png, (all_isbns & md5_isbns).to_packed(), color=(255, 255, 0)
+            )
+            color_image(
+                all_isbns_png, (md5_isbns - all_isbns).to_packed(), color=(0, 255, 0)
+            )
+
+    with report.stage("encode", os.path.basename(filename)) as stage:
+        all_isbns_png.save(filename)
+        stage["bytes_written"] = os.path.getsize(filename)
+
+
 def main():
     args = docopt(__doc__)
     input_filename = args["--input"]
     suffix = args["--suffix"]
     output_dir = args["--output"]
+    engine = args["--engine"]
+    jobs = int(args["--jobs"])
+    memory = int(args["--memory"]) * MB
+    profile_stage = args["--profile"]
+    if engine not in ("pixel", "numpy", "band"):
+        print(f"Unknown engine {engine}, use pixel, numpy or band")
+        return
 
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
-    isbn_data = bencodepy.bread(
-        zstandard.ZstdDecompressor().stream_reader(open(input_filename, "rb"))
-    )
+    report = RunReport(profile_stage)
 
-    # Generate individual prefix images
-    print(f"### Generating *{suffix}.png...")
-    for prefix, packed_isbns_binary in isbn_data.items():
-        filename = f"{output_dir}/{prefix.decode()}{suffix}.png"
-        print(f"Generating {filename}...")
-        prefix_isbns_png = PIL.Image.new("1", (WIDTH, HEIGHT), 0)
-        color_image(prefix_isbns_png, packed_isbns_binary, color=1)
-        prefix_isbns_png.save(filename)
+    def submit(pool, packed_isbns_binary, intervals, images):
+        for _, filename in images:
+            pool.submit(render_prefix_image, packed_isbns_binary, filename, engine, memory, profile_stage)
+
+    def render_all(output, filename, all_isbns, md5_isbns):
+        render_all_image(filename, all_isbns, md5_isbns, engine, memory, report)
 
-    # Generate one combined image
-    print(f"### Generating {output_dir}/all{suffix}.png...")
-    unique_isbns = set()
-    all_isbns_png = PIL.Image.new("RGB", (WIDTH, HEIGHT), (0, 0, 0))
-    for prefix, packed_isbns_binary in isbn_data.items():
-        if prefix == b"md5":
-            continue
-        print(f"Adding {prefix.decode()} to {output_dir}/all{suffix}.png")
-        color_image(
-            all_isbns_png,
-            packed_isbns_binary,
-            color=(255, 0, 0),
-            unique_isbns=unique_isbns,
-        )
-
-    # Finally, add md5 in green, if present.
-    if b"md5" in isbn_data:
-        print(f"Adding md5 to {output_dir}/all{suffix}.png")
-        color_image(all_isbns_png, isbn_data[b"md5"], addcolor=(0, 255, 0))
-
-    all_isbns_png.save(f"{output_dir}/all{suffix}.png")
+    print(f"### Generating *{suffix}.png...")
+    render_dump(
+        report.iter_stage("read", iter_packed_isbns(input_filename), prefix_fields),
+        output_dir,
+        {"hd": (suffix, (engine, *CACHE_OPTIONS))},
+        submit,
+        render_all,
+        jobs,
+        open_cache(args["--cache"], args["--cache-size"]),
+        report,
+    )
+    report.finish(args["--report"])
     print("Done.")
 
 
@@ -0,0 +1,525 @@
+"""Render HD map tiles directly from the ISBN intervals.
+
+Writes the same tile directories as make_isbn_images_fractal.py followed by
+make_isbn_images_2_tiling.py --depth one --move-dir, without building the
+full size image: each tile only looks up the ISBN positions of its pixels.
+
+With --levels, zoomed out levels are added below the HD one. Each of their
+pixels aggregates (sum or max) the ISBN counts of a 2x2 block of the level
+above, computed bottom-up in one pass over the HD tiles. Level directories
+are then numbered from the most zoomed out one.
+
+With --cache, the tile sets of prefixes whose packed ISBNs were already
+rendered with the same options are copied from the render cache.
+
+With --previous (delta mode), the tile sets written from the previous dump
+are updated in place: the symmetric difference of the ISBNs of each prefix
+in both dumps is mapped through the layout to the tiles holding them at
+every level, and only these tiles are rendered again. The two dumps are read
+side by side, one prefix at a time. Tile sets missing from the output
+directory are rendered in full. --changes writes the changed ISBN ranges as
+JSON.
+
+Usage:
+    make_isbn_images_tiles.py [options]
+
+Options:
+    -i --input=<file>       Input filename [default: aa_isbn13_codes_20241204T185335Z.benc.zst]
+    -x --suffix=<suffix>    Output name suffix [default: _hd]
+    -o --output=<dir>       Output directory [default: images]
+    -t --tile-size=<n>      Size of tile square [default: 512]
+    -r --resize=<list>      Comma separated resize factors (powers of 2), one level each [default: 1]
+    -l --levels=<n>         Number of aggregated zoomed out levels [default: 0]
+    -a --aggregate=<mode>   Aggregation of zoomed out levels: sum or max [default: sum]
+    -j --jobs=<n>           Number of processes rendering tiles [default: 1]
+    --cache=<dir>           Render cache directory, none by default
+    --cache-size=<mb>       Size limit of the render cache, in MB [default: 10240]
+    -p --previous=<file>    Previous dump, only rewrite the tiles changed since it
+    --changes=<file>        Write the ISBN ranges changed since --previous as JSON
+    -h --help               Show this help message
+
+Example:
+    python make_isbn_images_tiles.py -o ../isbn_images_data/images -r 1,2,4,8 -j 8
+    python make_isbn_images_tiles.py -o ../isbn_images_data/images -r 1,2,4,8 -l 7 -j 8
+    python make_isbn_images_tiles.py -i new.benc.zst -p old.benc.zst -o ../isbn_images_data/images -r 1,2,4,8 -l 7 -j 8
+"""
+
+import concurrent.futures
+import json
+import os
+import sys
+
+import numpy as np
+import PIL.Image
+import tqdm
+from docopt import docopt
+
+from benc_stream import iter_packed_isbns, merge_packed_isbns
+from isbn_intervals import IntervalSet, iter_positions
+from isbn_registry import ISBN12_OFFSET
+from make_isbn_images_fractal import BLOCK_HEIGHT, BLOCK_WIDTH, CACHE_OPTIONS, HEIGHT, LAYOUT, WIDTH
+from render_cache import cache_key, open_cache
+
+# Set in each worker by _init_tile_job()
+_tile_job = None
+
+
+def tile_mask(intervals, x0, x1, y0, y1, resize):
+    """
+    Boolean mask of the pixels [y0, y1) x [x0, x1) of the image scaled by
+    resize (nearest neighbour) telling which ones are in the IntervalSet.
+    """
+    src_x = np.arange(x0, x1) // resize
+    src_y = np.arange(y0, y1) // resize
+    src_x0, src_y0 = src_x[0], src_y[0]
+    positions = LAYOUT.find_position(
+        np.arange(src_x0, src_x[-1] + 1)[None, :], np.arange(src_y0, src_y[-1] + 1)[:, None]
+    )
+    mask = intervals.contains(positions)
+    if resize > 1:
+        mask = mask[(src_y - src_y0)[:, None], (src_x - src_x0)[None, :]]
+    return mask
+
+
+def tile_image(sets, x0, x1, y0, y1, resize):
+    """
+    Grayscale tile for a single IntervalSet, or the red/green tile of the
+    combined image for (all ISBNs, md5 ISBNs).
+    """
+    masks = [tile_mask(intervals, x0, x1, y0, y1, resize) for intervals in sets]
+    if len(masks) == 1:
+        return PIL.Image.fromarray(masks[0].astype(np.uint8) * 255)
+    rgb = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    rgb[:, :, 0] = masks[0] * 255
+    rgb[:, :, 1] = masks[1] * 255
+    return PIL.Image.fromarray(rgb)
+
+
+def tile_ranges(size, tile_size):
+    """Yield (index, start, end) of the tiles covering size pixels."""
+    for index, start in enumerate(range(0, size, tile_size)):
+        yield index, start, min(start + tile_size, size)
+
+
+def level_size(shrink):
+    """Width and height of the HD image shrunk 2**shrink times."""
+    return -(-WIDTH // 2**shrink), -(-HEIGHT // 2**shrink)
+
+
+def split_shrink(levels, tile_size, jobs):
+    """
+    Shrink of the level whose tiles are the tasks of the bottom-up pass: the
+    most zoomed out one with at least jobs tiles, the HD level at worst.
+    """
+    for shrink in range(levels, 0, -1):
+        width, height = level_size(shrink)
+        if -(-width // tile_size) * -(-height // tile_size) >= jobs:
+            return shrink
+    return 0
+
+
+def counts_image(counts, shrink, aggregate):
+    """
+    Tile image of ISBN counts aggregated over 2**shrink x 2**shrink HD pixels.
+    Sums are drawn as densities, like the cluster images, max as presence.
+    """
+    if aggregate == "sum":
+        levels = np.rint(counts * (255 / 4**shrink)).astype(np.int64)
+    else:
+        levels = np.minimum(counts, 1) * 255
+    if counts.shape[2] == 1:
+        return PIL.Image.fromarray(levels[:, :, 0].astype(np.uint8))
+    rgb = np.zeros(counts.shape[:2] + (3,), dtype=np.uint8)
+    if aggregate == "sum":
+        # md5 density is taken out of the red channel
+        rgb[:, :, 0] = np.maximum(levels[:, :, 0] - levels[:, :, 1], 0)
+    else:
+        rgb[:, :, 0] = levels[:, :, 0]
+    rgb[:, :, 1] = levels[:, :, 1]
+    return PIL.Image.fromarray(rgb)
+
+
+def count_tile(sets, shrink, col, row, tile_size, aggregate, write, known=None):
+    """
+    ISBN counts of every pixel of tile (col, row) of the HD image shrunk
+    2**shrink times, as a (height, width, len(sets)) array. HD tiles come
+    from the intervals, the others from the 2x2 blocks of their (up to) four
+    child tiles, which are computed and written depth first.
+    write(shrink, col, row, counts) is called for every tile, except the
+    ones already written whose counts are taken from known, a dict
+    {(shrink, col, row): counts}.
+    """
+    if known is not None and (shrink, col, row) in known:
+        return known.pop((shrink, col, row))
+    width, height = level_size(shrink)
+    x0, x1 = col * tile_size, min((col + 1) * tile_size, width)
+    y0, y1 = row * tile_size, min((row + 1) * tile_size, height)
+    if shrink == 0:
+        counts = np.stack(
+            [tile_mask(intervals, x0, x1, y0, y1, 1) for intervals in sets], axis=-1
+        ).astype(np.int64)
+    else:
+        child_width, child_height = level_size(shrink - 1)
+        counts = np.zeros((y1 - y0, x1 - x0, len(sets)), dtype=np.int64)
+        for dy in (0, 1):
+            for dx in (0, 1):
+                child_col = 2 * col + dx
+                child_row = 2 * row + dy
+                if child_col * tile_size >= child_width or child_row * tile_size >= child_height:
+                    continue
+                child = count_tile(sets, shrink - 1, child_col, child_row, tile_size, aggregate, write, known)
+                # Each child is aggregated as soon as computed, so that only one
+                # is held per level. With an odd tile size, the 2x2 blocks on
+                # its top or left edge are shared with the previous child.
+                top = dy * tile_size
+                left = dx * tile_size
+                block_rows = -(-(top % 2 + child.shape[0]) // 2)
+                block_cols = -(-(left % 2 + child.shape[1]) // 2)
+                padded = np.zeros((2 * block_rows, 2 * block_cols, len(sets)), dtype=np.int64)
+                padded[top % 2:top % 2 + child.shape[0], left % 2:left % 2 + child.shape[1]] = child
+                del child
+                blocks = padded.reshape(block_rows, 2, block_cols, 2, len(sets))
+                target = counts[top // 2:top // 2 + block_rows, left // 2:left // 2 + block_cols]
+                if aggregate == "sum":
+                    target += blocks.sum(axis=(1, 3))
+                else:
+                    np.maximum(target, blocks.max(axis=(1, 3)), out=target)
+    write(shrink, col, row, counts)
+    return counts
+
+
+def tile_counts(sets, shrink, col, row, tile_size):
+    """
+    Same counts as count_tile(), computed from the ISBNs of the blocks of
+    consecutive positions laid out in the tile instead of from its child
+    tiles, so that a single tile of a zoomed out level can be rendered.
+    """
+    width, height = level_size(shrink)
+    x0, x1 = col * tile_size, min((col + 1) * tile_size, width)
+    y0, y1 = row * tile_size, min((row + 1) * tile_size, height)
+    hd_x0, hd_x1 = x0 << shrink, min(x1 << shrink, WIDTH)
+    hd_y0, hd_y1 = y0 << shrink, min(y1 << shrink, HEIGHT)
+    block_xs = np.arange(hd_x0 - hd_x0 % BLOCK_WIDTH, hd_x1, BLOCK_WIDTH)
+    block_ys = np.arange(hd_y0 - hd_y0 % BLOCK_HEIGHT, hd_y1, BLOCK_HEIGHT)
+    starts = LAYOUT.find_position(block_xs[None, :], block_ys[:, None]).ravel()
+    counts = np.zeros((y1 - y0, x1 - x0, len(sets)), dtype=np.int64)
+    for index, intervals in enumerate(sets):
+        selected = intervals.clip(starts, starts + BLOCK_WIDTH * BLOCK_HEIGHT)
+        for positions in iter_positions(selected.starts, selected.ends):
+            xs, ys = LAYOUT.get_xy(positions)
+            # Blocks on the edges of the tile are partly outside of it
+            inside = (xs >= hd_x0) & (xs < hd_x1) & (ys >= hd_y0) & (ys < hd_y1)
+            pixels = ((ys[inside] >> shrink) - y0) * (x1 - x0) + (xs[inside] >> shrink) - x0
+            counts[:, :, index] += np.bincount(pixels, minlength=(y1 - y0) * (x1 - x0)).reshape(y1 - y0, x1 - x0)
+    return counts
+
+
+def _add_tiles(tiles, cols, rows):
+    cells = np.unique((cols << 32) | rows)
+    tiles.update(zip((cells >> 32).tolist(), (cells & 0xFFFFFFFF).tolist()))
+
+
+def changed_tiles(changed, tile_size, resizes, levels=0):
+    """
+    Tiles holding the pixels of the positions of the IntervalSet changed, as
+    {level: set of (col, row)} for the levels written by render_tiles().
+    Resize factors are expected not to exceed the tile size.
+    """
+    tiles = {level: set() for level in range(levels + len(resizes))}
+    for positions in iter_positions(changed.starts, changed.ends):
+        xs, ys = LAYOUT.get_xy(positions)
+        inside = (xs < WIDTH) & (ys < HEIGHT)
+        xs = xs[inside]
+        ys = ys[inside]
+        for index, resize in enumerate(resizes):
+            _add_tiles(tiles[levels + index], xs * resize // tile_size, ys * resize // tile_size)
+            if tile_size % resize:
+                # The scaled pixel may end on the next tile
+                _add_tiles(
+                    tiles[levels + index],
+                    (xs * resize + resize - 1) // tile_size,
+                    (ys * resize + resize - 1) // tile_size,
+                )
+        for shrink in range(1, levels + 1):
+            _add_tiles(tiles[levels - shrink], (xs >> shrink) // tile_size, (ys >> shrink) // tile_size)
+    return tiles
+
+
+def _init_tile_job(tile_job):
+    global _tile_job
+    _tile_job = tile_job
+
+
+def _render_tile_row(level, resize, row, y0, y1):
+    sets = _tile_job["sets"]
+    tile_size = _tile_job["tile_size"]
+    level_dir = f"{_tile_job['output']}/{level}"
+    for col, x0, x1 in tile_ranges(WIDTH * resize, tile_size):
+        tile_image(sets, x0, x1, y0, y1, resize).save(f"{level_dir}/{col}_{row}.png")
+
+
+def _render_tile(level, resize, col, row):
+    tile_size = _tile_job["tile_size"]
+    x0, y0 = col * tile_size, row * tile_size
+    x1, y1 = min(x0 + tile_size, WIDTH * resize), min(y0 + tile_size, HEIGHT * resize)
+    tile_image(_tile_job["sets"], x0, x1, y0, y1, resize).save(
+        f"{_tile_job['output']}/{level}/{col}_{row}.png"
+    )
+
+
+def _render_counts_tile(shrink, col, row):
+    counts = tile_counts(_tile_job["sets"], shrink, col, row, _tile_job["tile_size"])
+    level = _tile_job["levels"] - shrink
+    counts_image(counts, shrink, _tile_job["aggregate"]).save(
+        f"{_tile_job['output']}/{level}/{col}_{row}.png"
+    )
+
+
+def _write_counts_tile(shrink, col, row, counts):
+    levels = _tile_job["levels"]
+    if shrink == 0:
+        if _tile_job["hd_level"] is None:
+            return
+        level = _tile_job["hd_level"]
+        counts_image(counts, 0, "max").save(f"{_tile_job['output']}/{level}/{col}_{row}.png")
+    else:
+        level = levels - shrink
+        counts_image(counts, shrink, _tile_job["aggregate"]).save(
+            f"{_tile_job['output']}/{level}/{col}_{row}.png"
+        )
+
+
+def _render_aggregated_tile(shrink, col, row):
+    counts = count_tile(
+        _tile_job["sets"],
+        shrink,
+        col,
+        row,
+        _tile_job["tile_size"],
+        _tile_job["aggregate"],
+        _write_counts_tile,
+    )
+    # The levels above are built by the parent from these counts
+    if shrink < _tile_job["levels"]:
+        return counts
+
+
+def render_tiles(sets, output, tile_size, resizes, jobs=1, levels=0, aggregate="sum"):
+    """
+    Write the tiles of every resize factor to output/<level>/<col>_<row>.png,
+    level being levels + the index of the factor in resizes. Levels
+    0 to levels - 1 hold the aggregated zoomed out levels; when there are
+    some, the resize 1 tiles are written by the same bottom-up pass, split
+    into the subtrees of the tiles of split_shrink() run in parallel, the
+    few levels above them being built in this process.
+    """
+    hd_level = None
+    if levels and 1 in resizes:
+        hd_level = levels + resizes.index(1)
+    tile_job = {
+        "sets": sets,
+        "output": output,
+        "tile_size": tile_size,
+        "levels": levels,
+        "aggregate": aggregate,
+        "hd_level": hd_level,
+    }
+    tasks = []
+    for index, resize in enumerate(resizes):
+        level = levels + index
+        os.makedirs(f"{output}/{level}", exist_ok=True)
+        if level == hd_level:
+            continue
+        for row, y0, y1 in tile_ranges(HEIGHT * resize, tile_size):
+            tasks.append((_render_tile_row, (level, resize, row, y0, y1)))
+    if levels:
+        for level in range(levels):
+            os.makedirs(f"{output}/{level}", exist_ok=True)
+        split = split_shrink(levels, tile_size, jobs)
+        width, height = level_size(split)
+        for row, _, _ in tile_ranges(height, tile_size):
+            for col, _, _ in tile_ranges(width, tile_size):
+                tasks.append((_render_aggregated_tile, (split, col, row)))
+
+    results = _run_tile_tasks(tile_job, tasks, jobs)
+    if levels and split < levels:
+        known = {args: counts for (fn, args), counts in zip(tasks, results) if fn is _render_aggregated_tile}
+        _init_tile_job(tile_job)
+        width, height = level_size(levels)
+        for row, _, _ in tile_ranges(height, tile_size):
+            for col, _, _ in tile_ranges(width, tile_size):
+                count_tile(sets, levels, col, row, tile_size, aggregate, _write_counts_tile, known)
+
+
+def update_tiles(sets, output, tiles, tile_size, resizes, jobs=1, levels=0, aggregate="sum"):
+    """
+    Render again the tiles {level: set of (col, row)} of a tile set written
+    by render_tiles() with the same options, in place.
+    """
+    tile_job = {
+        "sets": sets,
+        "output": output,
+        "tile_size": tile_size,
+        "levels": levels,
+        "aggregate": aggregate,
+    }
+    tasks = []
+    for index, resize in enumerate(resizes):
+        # The resize 1 level of the bottom-up pass has the same pixels
+        for col, row in sorted(tiles[levels + index]):
+            tasks.append((_render_tile, (levels + index, resize, col, row)))
+    for level in range(levels):
+        for col, row in sorted(tiles[level]):
+            tasks.append((_render_counts_tile, (levels - level, col, row)))
+    _run_tile_tasks(tile_job, tasks, jobs)
+
+
+def _run_tile_tasks(tile_job, tasks, jobs):
+    """Run the tasks, returning their results in the same order."""
+    if jobs == 1:
+        _init_tile_job(tile_job)
+        return [fn(*args) for fn, args in tqdm.tqdm(tasks)]
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=_init_tile_job, initargs=(tile_job,)
+    ) as executor:
+        futures = [executor.submit(fn, *args) for fn, args in tasks]
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            future.result()
+        return [future.result() for future in futures]
+
+
+def write_tile_set(sets, output, tile_size, resizes, jobs, levels, aggregate, changed=None, cache=None, key=None):
+    """
+    Write the tile set of sets to output. In delta mode (changed given and
+    output already written), only the tiles of the positions of the
+    IntervalSet changed are rendered again. Otherwise the tile set is
+    restored from the render cache, or rendered in full.
+    """
+    if changed is not None and os.path.isdir(output):
+        if len(changed) == 0:
+            print(f"{output} unchanged")
+            return
+        tiles = changed_tiles(changed, tile_size, resizes, levels)
+        print(f"Updating {sum(len(level_tiles) for level_tiles in tiles.values())} tiles of {output}...")
+        update_tiles(sets, output, tiles, tile_size, resizes, jobs, levels, aggregate)
+    elif key is not None and cache.restore(key, output):
+        print(f"Restored {output} from the cache")
+        return
+    else:
+        print(f"Generating {output}...")
+        render_tiles(sets, output, tile_size, resizes, jobs, levels, aggregate)
+    if key is not None:
+        cache.store(key, output)
+
+
+def describe_changes(name, previous, current, changed):
+    """
+    Changes of the ISBNs of a prefix, changed being previous ^ current.
+    Ranges are half-open [start, end) ISBN12 (without check digit).
+    """
+    added = (current - previous).count()
+    removed = (previous - current).count()
+    print(f"{name}: {added} ISBNs added, {removed} removed, in {len(changed)} ranges")
+    return {
+        "prefix": name,
+        "added": added,
+        "removed": removed,
+        "ranges": (np.stack((changed.starts, changed.ends), axis=1) + ISBN12_OFFSET).tolist(),
+    }
+
+
+def main():
+    args = docopt(__doc__)
+    input_filename = args["--input"]
+    suffix = args["--suffix"]
+    output_dir = args["--output"]
+    tile_size = int(args["--tile-size"])
+    resizes = [int(r) for r in args["--resize"].split(",")]
+    jobs = int(args["--jobs"])
+    levels = int(args["--levels"])
+    aggregate = args["--aggregate"]
+    if args["--changes"] and not args["--previous"]:
+        print("--changes needs the previous dump, given with --previous")
+        sys.exit(1)
+    if aggregate not in ("sum", "max"):
+        print(f"Unknown aggregate {aggregate}, use sum or max")
+        sys.exit(1)
+
+    # Validate resize factors are powers of 2
+    if any(r < 1 or r & (r - 1) != 0 for r in resizes):
+        print("Error: resize factors must be powers of 2")
+        sys.exit(1)
+
+    cache = open_cache(args["--cache"], args["--cache-size"])
+    options = ("tiles", tile_size, tuple(resizes), levels, aggregate, *CACHE_OPTIONS)
+    prefix_keys = []
+    all_isbns = IntervalSet()
+    md5_isbns = IntervalSet()
+
+    # Delta mode: both dumps are walked together, prefix by prefix, only
+    # the unions of the previous ISBNs being kept
+    delta = bool(args["--previous"])
+    changes = []
+    previous_all = IntervalSet()
+    previous_md5 = IntervalSet()
+    if delta:
+        items = merge_packed_isbns(args["--previous"], input_filename)
+    else:
+        items = ((prefix, None, packed) for prefix, packed in iter_packed_isbns(input_filename))
+
+    for prefix, previous_packed, packed_isbns_binary in items:
+        output = f"{output_dir}/{prefix.decode()}{suffix}_t_files"
+        if delta:
+            previous_intervals = IntervalSet()
+            if previous_packed is not None:
+                previous_intervals = IntervalSet.from_packed(previous_packed)
+            if prefix == b"md5":
+                previous_md5 = previous_intervals
+            else:
+                previous_all = previous_all | previous_intervals
+            if packed_isbns_binary is None:
+                # Prefixes gone from the dump are emptied
+                changes.append(describe_changes(prefix.decode(), previous_intervals, IntervalSet(), previous_intervals))
+                if os.path.isdir(output):
+                    write_tile_set([IntervalSet()], output, tile_size, resizes, jobs, levels, aggregate, previous_intervals)
+                continue
+
+        intervals = IntervalSet.from_packed(packed_isbns_binary)
+        key = None
+        if cache is not None:
+            key = cache_key(packed_isbns_binary, *options)
+            prefix_keys.append(prefix + b":" + key.encode())
+        changed = None
+        if delta:
+            changed = previous_intervals ^ intervals
+            changes.append(describe_changes(prefix.decode(), previous_intervals, intervals, changed))
+        write_tile_set([intervals], output, tile_size, resizes, jobs, levels, aggregate, changed, cache, key)
+
+        # md5 is added in green, the other prefixes in red
+        if prefix == b"md5":
+            md5_isbns = intervals
+        else:
+            all_isbns = all_isbns | intervals
+
+    changed = None
+    if delta:
+        changed = (previous_all ^ all_isbns) | (previous_md5 ^ md5_isbns)
+        changes.append(describe_changes("all", previous_all | previous_md5, all_isbns | md5_isbns, changed))
+
+    output = f"{output_dir}/all{suffix}_t_files"
+    all_key = None
+    if cache is not None:
+        all_key = cache_key(b" ".join(prefix_keys), "all", *options)
+    write_tile_set([all_isbns, md5_isbns], output, tile_size, resizes, jobs, levels, aggregate, changed, cache, all_key)
+
+    if args["--changes"]:
+        with open(args["--changes"], "w") as f:
+            json.dump({"previous": args["--previous"], "input": input_filename, "prefixes": changes}, f)
+        print(f"Changed ranges written to {args['--changes']}")
+    if cache is not None:
+        cache.print_stats()
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Generate synthetic dumps to run and measure the scripts without the real ones.
+
+Writes an aa_isbn13_codes *.benc.zst dump and an isbngrp_records
+*.jsonl.seekable.zst dump with the same formats as the Anna's Archive ones.
+Publishers get a prefix under a registration group of isbn_registry, and the
+ISBNs of each dump prefix are runs laid out from the start of the publisher
+ranges, a few big publishers holding most of them. --density is the share
+of the positions covered by runs in these ranges, the rest being gaps.
+
+Usage:
+    make_synthetic_dumps.py [options]
+
+Options:
+    -o --output=<dir>       Output directory [default: synthetic]
+    -n --isbns=<n>          Approximate number of ISBNs of each dump prefix [default: 1000000]
+    -p --prefixes=<list>    Comma separated dump prefixes [default: ia,md5,ol]
+    -r --records=<n>        Number of isbngrp records [default: 10000]
+    -d --density=<f>        Share of the publisher range positions in runs [default: 0.3]
+    -l --run-length=<n>     Mean length of a run of ISBNs [default: 20]
+    -s --seed=<n>           Random seed [default: 0]
+    -h --help               Show this help message
+
+Example:
+    python make_synthetic_dumps.py -o synthetic -n 10000000 -r 100000
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import zstandard
+from docopt import docopt
+
+from isbn_intervals import IntervalSet
+from isbn_registry import ISBN12_OFFSET, countries, prefix_digits, prefix_range
+from seekable_zstd import write_seekable
+
+DUMP_FILENAME = "aa_isbn13_codes_synthetic.benc.zst"
+RECORDS_FILENAME = "annas_archive_meta__aacid__isbngrp_records__synthetic.jsonl.seekable.zst"
+# Registration groups holding most of the publishers, as in the real dump
+MAIN_GROUPS = ["978-0", "978-1", "978-2", "978-3", "978-4", "978-5", "978-7", "978-84", "978-85", "978-88", "979-8", "979-10"]
+RECORDS_PER_FRAME = 10000
+# Digits left for the titles of the longest publisher prefixes
+MIN_TITLE_DIGITS = 2
+
+
+def isbn13(isbn12):
+    """ISBN13 string of an ISBN12 integer, with its check digit."""
+    digits = str(isbn12)
+    total = sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(digits))
+    return f"{digits}{(10 - total % 10) % 10}"
+
+
+def synthetic_publishers(count, rng):
+    """
+    List of (prefix, registrant, country), publishers being ordered from the
+    biggest to the smallest. Big publishers get short prefixes.
+    """
+    groups = list(countries)
+    publishers = []
+    seen = set()
+    while len(publishers) < count:
+        if rng.random() < 0.8:
+            group = MAIN_GROUPS[rng.integers(len(MAIN_GROUPS))]
+        else:
+            group = groups[rng.integers(len(groups))]
+        free_digits = 12 - MIN_TITLE_DIGITS - len(prefix_digits(group))
+        rank = len(publishers) / count
+        length = min(free_digits, 2 + int(rank * (free_digits - 1)) + int(rng.integers(2)))
+        prefix = f"{group}-{rng.integers(10**length):0{length}d}"
+        if prefix in seen:
+            continue
+        seen.add(prefix)
+        publishers.append((prefix, f"Synthetic Publisher {len(publishers)}", countries[group]))
+    return publishers
+
+
+def iter_record_lines(publishers, rng):
+    """Yield the jsonl lines of the isbngrp records of the publishers."""
+    for index, (prefix, registrant, country) in enumerate(publishers):
+        isbns = [{"isbn": prefix, "isbn_type": "prefix"}]
+        if rng.random() < 0.2:
+            start, end = prefix_range(prefix)
+            isbns.append({"isbn": isbn13(ISBN12_OFFSET + int(rng.integers(start, end))), "isbn_type": "isbn13"})
+        record = {
+            "registrant_name": registrant,
+            "agency_name": f"{country} ISBN Agency",
+            "country_name": country,
+            "isbns": isbns,
+        }
+        # A few records come without registrant, as in the real dump
+        if rng.random() < 0.01:
+            del record["registrant_name"]
+        line = {"aacid": f"aacid__isbngrp_records__synthetic__{index}", "metadata": {"id": index, "record": record}}
+        yield json.dumps(line, ensure_ascii=False)
+
+
+def write_records(filename, publishers, rng):
+    """Write the isbngrp records as a seekable zstd jsonl file."""
+    lines = list(iter_record_lines(publishers, rng))
+    chunks = (
+        "".join(f"{line}\n" for line in lines[i : i + RECORDS_PER_FRAME]).encode("utf-8")
+        for i in range(0, len(lines), RECORDS_PER_FRAME)
+    )
+    with open(filename, "wb") as fh:
+        write_seekable(fh, chunks)
+
+
+def synthetic_intervals(publishers, isbns, density, run_length, rng):
+    """
+    IntervalSet of about isbns positions: runs of mean length run_length
+    laid out from the start of the publisher ranges, separated by gaps so
+    that runs cover density of the positions they span.
+    """
+    run_count = max(1, isbns // run_length)
+    weights = 1.0 / np.arange(1, len(publishers) + 1)
+    owners = np.sort(rng.choice(len(publishers), run_count, p=weights / weights.sum()))
+    ranges = np.array([prefix_range(prefix) for prefix, _, _ in publishers], dtype=np.int64)
+    lengths = rng.geometric(1.0 / run_length, run_count)
+    mean_gap = run_length * (1 - density) / density
+    gaps = rng.geometric(1.0 / (mean_gap + 1), run_count) - 1
+    # Offsets restart at the first run of every publisher
+    steps = np.cumsum(gaps + lengths)
+    first = np.flatnonzero(np.concatenate(([True], owners[1:] != owners[:-1])))
+    before = np.repeat(steps[first] - (gaps + lengths)[first], np.diff(np.append(first, run_count)))
+    ends = ranges[owners, 0] + steps - before
+    starts = ends - lengths
+    ends = np.minimum(ends, ranges[owners, 1])
+    return IntervalSet.from_intervals(starts, ends)
+
+
+def write_dump(filename, packed_isbns):
+    """Write a bencoded {prefix: packed ISBNs} dictionary compressed with zstd."""
+    with open(filename, "wb") as fh:
+        with zstandard.ZstdCompressor().stream_writer(fh) as writer:
+            writer.write(b"d")
+            for prefix in sorted(packed_isbns):
+                value = packed_isbns[prefix]
+                writer.write(b"%d:%s%d:" % (len(prefix), prefix, len(value)))
+                writer.write(value)
+            writer.write(b"e")
+
+
+def generate(output_dir, isbns=1000000, prefixes=("ia", "md5", "ol"), records=10000, density=0.3, run_length=20, seed=0):
+    """Write both synthetic dumps to output_dir and return their filenames."""
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    publishers = synthetic_publishers(records, rng)
+    records_filename = f"{output_dir}/{RECORDS_FILENAME}"
+    write_records(records_filename, publishers, rng)
+
+    packed_isbns = {}
+    for prefix in prefixes:
+        intervals = synthetic_intervals(publishers, isbns, density, run_length, rng)
+        print(f"{prefix}: {len(intervals)} runs, {intervals.count()} ISBNs")
+        packed_isbns[prefix.encode()] = intervals.to_packed()
+    dump_filename = f"{output_dir}/{DUMP_FILENAME}"
+    write_dump(dump_filename, packed_isbns)
+    return dump_filename, records_filename
+
+
+def main():
+    args = docopt(__doc__)
+    density = float(args["--density"])
+    if not 0 < density <= 1:
+        print(f"Density must be in ]0, 1], got {density}")
+        sys.exit(1)
+    dump_filename, records_filename = generate(
+        args["--output"],
+        isbns=int(args["--isbns"]),
+        prefixes=args["--prefixes"].split(","),
+        records=int(args["--records"]),
+        density=density,
+        run_length=int(args["--run-length"]),
+        seed=int(args["--seed"]),
+    )
+    print(f"Dump written to {dump_filename}")
+    print(f"Records written to {records_filename}")
+
+
+if __name__ == "__main__":
+    main()
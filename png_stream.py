@@ -0,0 +1,91 @@
+"""Streaming PNG writer for images too large to be held in memory.
+
+Rows are compressed and written as they are produced, so only the rows of
+the band being rendered are in memory. Modes:
+- 1: black and white, rows given as boolean arrays
+- L: 8 bit grayscale, rows given as uint8 arrays
+- RGB: 8 bit color, rows given as (rows, width, 3) uint8 arrays
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# mode: (bit depth, color type)
+MODES = {"1": (1, 0), "L": (8, 0), "RGB": (8, 2)}
+IDAT_SIZE = 1 << 20
+
+
+class PNGWriter:
+    """Context manager writing the rows of a PNG image from top to bottom."""
+
+    def __init__(self, filename, width, height, mode="1", level=6):
+        if mode not in MODES:
+            raise ValueError(f"Unknown PNG mode {mode}, use one of {', '.join(MODES)}")
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.level = level
+        self.rows = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.filename, "wb")
+        self.compressor = zlib.compressobj(self.level)
+        self.pending = []
+        self.pending_size = 0
+        bit_depth, color_type = MODES[self.mode]
+        self.file.write(PNG_SIGNATURE)
+        self._chunk(
+            b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, bit_depth, color_type, 0, 0, 0)
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                if self.rows != self.height:
+                    raise ValueError(f"{self.rows} rows written out of {self.height}")
+                self._compressed(self.compressor.flush())
+                self._flush_idat()
+                self._chunk(b"IEND", b"")
+        finally:
+            self.file.close()
+
+    def write(self, rows):
+        """Append rows (one row per item of the first axis) to the image."""
+        rows = np.asarray(rows)
+        if len(rows) == 0:
+            return
+        if self.rows + len(rows) > self.height:
+            raise ValueError(f"More than {self.height} rows written")
+        if self.mode == "1":
+            data = np.packbits(rows.astype(bool, copy=False), axis=1)
+        else:
+            data = rows.astype(np.uint8, copy=False).reshape(len(rows), -1)
+        # Every row starts with its filter type, 0 (None)
+        filtered = np.zeros((len(rows), data.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 1:] = data
+        self._compressed(self.compressor.compress(filtered))
+        self.rows += len(rows)
+
+    def _compressed(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= IDAT_SIZE:
+            self._flush_idat()
+
+    def _flush_idat(self):
+        if self.pending_size:
+            self._chunk(b"IDAT", b"".join(self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
@@ -0,0 +1,130 @@
+"""Content addressed cache of rendered images and tile sets.
+
+Most prefixes of the dump have the same packed ISBNs from one release to
+the next. An entry is keyed by the SHA-256 of the data it was rendered
+from (the packed ISBNs of a prefix, or the image being tiled) together
+with the layout and options of the render, so that unchanged prefixes are
+copied back from the cache instead of being rendered again.
+
+Entries are files or directory trees stored as <cache dir>/<key>. The
+cache is kept under a size limit by evicting the least recently used
+entries, index.json recording the size and last use of every entry. The
+cache is meant to be used by one process at a time: workers render, the
+parent restores and stores.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from run_report import directory_size
+
+# Bump to invalidate every entry when the rendering changes
+CACHE_VERSION = 1
+HASH_CHUNK = 1 << 24
+
+
+def cache_key(data, *options):
+    """Key of the render of data (bytes-like) with options (any repr-able values)."""
+    hasher = hashlib.sha256(repr((CACHE_VERSION,) + options).encode())
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def file_digest(filename):
+    """SHA-256 digest of the content of a file, to be used as cache_key() data."""
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK), b""):
+            hasher.update(chunk)
+    return hasher.digest()
+
+
+class RenderCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_filename = f"{directory}/index.json"
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename) as f:
+                self.index = json.load(f)
+
+    def _path(self, key):
+        return f"{self.directory}/{key}"
+
+    def restore(self, key, target):
+        """
+        Copy the entry of key to target, a file or a directory (merged with
+        the existing one). Returns False, counting a miss, if there is none.
+        """
+        path = self._path(key)
+        if key not in self.index or not os.path.exists(path):
+            self.misses += 1
+            return False
+        if os.path.isdir(path):
+            shutil.copytree(path, target, dirs_exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            shutil.copyfile(path, target)
+        self.index[key]["used"] = time.time()
+        self.hits += 1
+        self._save_index()
+        return True
+
+    def store(self, key, source):
+        """Copy source, a file or a directory, as the entry of key."""
+        path = self._path(key)
+        partial = f"{path}.partial"
+        self._remove(partial)
+        if os.path.isdir(source):
+            shutil.copytree(source, partial)
+            size = directory_size(partial)[1]
+        else:
+            shutil.copyfile(source, partial)
+            size = os.path.getsize(partial)
+        self._remove(path)
+        os.replace(partial, path)
+        self.index[key] = {"bytes": size, "used": time.time()}
+        self._evict()
+        self._save_index()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        total = sum(entry["bytes"] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self.index.pop(key)["bytes"]
+            self._remove(self._path(key))
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _save_index(self):
+        with open(f"{self.index_filename}.partial", "w") as f:
+            json.dump(self.index, f)
+        os.replace(f"{self.index_filename}.partial", self.index_filename)
+
+    def print_stats(self):
+        size = sum(entry["bytes"] for entry in self.index.values())
+        print(
+            f"Render cache: {self.hits} restored, {self.misses} rendered, "
+            f"{len(self.index)} entries, {size / (1 << 20):.1f} MB"
+        )
+
+
+def open_cache(directory, size_mb):
+    """RenderCache of the --cache and --cache-size options, None without --cache."""
+    if directory is None:
+        return None
+    return RenderCache(directory, int(size_mb) << 20)
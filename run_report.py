@@ -0,0 +1,200 @@
+"""Per stage timing and throughput report of a run.
+
+A stage (read, decode, render, encode...) is timed each time it runs, with
+the prefix or file it ran for, the number of ISBNs or records it handled,
+the bytes it read and wrote and the peak resident memory of the process at
+its end. Stages ran in worker processes are sent back to the parent with
+worker_result() and merge(). Stages can be nested, the time of the inner
+ones being included in the outer one. The report is written as JSON, with
+the totals and throughput of every stage.
+
+One stage can be profiled with cProfile, in the parent and in the workers;
+the merged statistics are written to <stage>.prof, readable with pstats or
+snakeviz.
+"""
+
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+
+MB = 1 << 20
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak * (1 if sys.platform == "darwin" else 1024) / MB
+
+
+class _ProfileStats:
+    """Raw cProfile stats of a worker, in the form pstats.Stats loads."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class RunReport:
+    def __init__(self, profile_stage=None):
+        self.profile_stage = profile_stage
+        self.started = time.time()
+        self.stages = []
+        self.profile = None
+
+    @contextlib.contextmanager
+    def stage(self, name, prefix=None):
+        """
+        Time the stage. The yielded dict takes the items, bytes_read and
+        bytes_written counts of the stage.
+        """
+        record = {"stage": name}
+        if prefix is not None:
+            record["prefix"] = prefix
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._add_profile(profiler)
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            if record.get("items") and record["seconds"]:
+                record["items_per_second"] = round(record["items"] / record["seconds"], 1)
+            record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+            record["pid"] = os.getpid()
+            self.stages.append(record)
+
+    def iter_stage(self, name, iterable, describe=None):
+        """
+        Yield the items of iterable, timing the production of each one as a
+        stage. describe(item) returns the fields (prefix, bytes_read...) of
+        the stage of an item.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as record:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                if describe is not None:
+                    record.update(describe(item))
+            yield item
+        # The last stage only found the end of iterable, no item
+        self.stages.pop()
+
+    def _add_profile(self, profiler):
+        profiler.create_stats()
+        self._add_profile_stats(profiler.stats)
+
+    def _add_profile_stats(self, stats):
+        if self.profile is None:
+            self.profile = pstats.Stats(_ProfileStats(stats))
+        else:
+            self.profile.add(pstats.Stats(_ProfileStats(stats)))
+
+    def worker_result(self):
+        """Stages and profile of a worker, to merge() in the parent report."""
+        return {"stages": self.stages, "profile": None if self.profile is None else self.profile.stats}
+
+    def merge(self, result):
+        """Add the worker_result() of a worker."""
+        self.stages.extend(result["stages"])
+        if result["profile"]:
+            self._add_profile_stats(result["profile"])
+
+    def totals(self):
+        """Per stage name: runs, seconds, items, bytes and throughput."""
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(
+                record["stage"], {"runs": 0, "seconds": 0.0, "items": 0, "bytes_read": 0, "bytes_written": 0}
+            )
+            total["runs"] += 1
+            total["seconds"] += record["seconds"]
+            for key in ("items", "bytes_read", "bytes_written"):
+                total[key] += record.get(key, 0)
+        for total in totals.values():
+            total["seconds"] = round(total["seconds"], 6)
+            if total["items"] and total["seconds"]:
+                total["items_per_second"] = round(total["items"] / total["seconds"], 1)
+            if total["bytes_read"] and total["seconds"]:
+                total["read_mb_per_second"] = round(total["bytes_read"] / MB / total["seconds"], 2)
+        return totals
+
+    def to_dict(self):
+        return {
+            "script": os.path.basename(sys.argv[0]),
+            "argv": sys.argv[1:],
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "seconds": round(time.time() - self.started, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "totals": self.totals(),
+            "stages": self.stages,
+        }
+
+    def print_totals(self):
+        print(f"{'stage':<12}{'runs':>6}{'seconds':>12}{'items/s':>14}{'read MB':>10}{'written MB':>12}")
+        for name, total in self.totals().items():
+            print(
+                f"{name:<12}{total['runs']:>6}{total['seconds']:>12.3f}"
+                f"{total.get('items_per_second', 0):>14.0f}"
+                f"{total['bytes_read'] / MB:>10.1f}{total['bytes_written'] / MB:>12.1f}"
+            )
+
+    def finish(self, filename=None):
+        """Write the report to filename if given, and the profile of the profiled stage."""
+        if filename:
+            with open(filename, "w") as f:
+                json.dump(self.to_dict(), f, indent=2)
+            self.print_totals()
+            print(f"Run report written to {filename}")
+        if self.profile_stage is not None:
+            if self.profile is None:
+                print(f"Stage {self.profile_stage} did not run, no profile written")
+                return
+            self.profile.dump_stats(f"{self.profile_stage}.prof")
+            print(f"Profile of stage {self.profile_stage} written to {self.profile_stage}.prof")
+
+
+def stage(report, name, prefix=None):
+    """report.stage(), or a stage recorded nowhere when report is None."""
+    if report is None:
+        return contextlib.nullcontext({})
+    return report.stage(name, prefix)
+
+
+def iter_stage(report, name, iterable, describe=None):
+    """report.iter_stage(), or iterable itself when report is None."""
+    if report is None:
+        return iterable
+    return report.iter_stage(name, iterable, describe)
+
+
+def prefix_fields(item):
+    """Stage fields of a (prefix, packed_isbns_binary) item of iter_packed_isbns()."""
+    prefix, packed_isbns_binary = item
+    return {"prefix": prefix.decode(), "bytes_read": len(packed_isbns_binary)}
+
+
+def directory_size(path):
+    """Number of files and total bytes under a directory."""
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
@@ -0,0 +1,154 @@
+"""Read zstd seekable format files (.seekable.zst) by independent frames.
+
+A seekable file is a series of independent zstd frames followed by a seek
+table (a skippable frame) listing the compressed and decompressed size of
+each frame. map_lines() splits the frames in contiguous ranges, each range
+being decompressed and parsed line by line in its own process.
+
+A line belongs to the range where it starts: a range skips everything up to
+its first newline and reads past its last frame until the end of its last
+line, so lines spanning frames are seen exactly once.
+"""
+
+import concurrent.futures
+import io
+import struct
+
+import zstandard as zstd
+
+SKIPPABLE_MAGIC_NUMBER = 0x184D2A5E
+SEEKABLE_MAGIC_NUMBER = 0x8F92EAB1
+FOOTER_SIZE = 9
+CHECKSUM_FLAG = 0x80
+
+
+def read_seek_table(fh):
+    """
+    Return the list of (compressed_offset, compressed_size, decompressed_size)
+    of the frames, or None if the file has no seek table.
+    """
+    fh.seek(0, io.SEEK_END)
+    file_size = fh.tell()
+    if file_size < FOOTER_SIZE + 8:
+        return None
+    fh.seek(file_size - FOOTER_SIZE)
+    frame_count, descriptor, magic = struct.unpack("<IBI", fh.read(FOOTER_SIZE))
+    if magic != SEEKABLE_MAGIC_NUMBER:
+        return None
+    entry_size = 12 if descriptor & CHECKSUM_FLAG else 8
+    table_size = frame_count * entry_size
+    fh.seek(file_size - FOOTER_SIZE - table_size - 8)
+    skippable_magic, frame_size = struct.unpack("<II", fh.read(8))
+    if skippable_magic != SKIPPABLE_MAGIC_NUMBER or frame_size != table_size + FOOTER_SIZE:
+        raise ValueError("Invalid zstd seek table")
+    table = fh.read(table_size)
+
+    frames = []
+    offset = 0
+    for i in range(frame_count):
+        compressed_size, decompressed_size = struct.unpack_from("<II", table, i * entry_size)
+        frames.append((offset, compressed_size, decompressed_size))
+        offset += compressed_size
+    return frames
+
+
+def write_seekable(fh, chunks, level=3):
+    """Write each bytes chunk as an independent frame, then the seek table."""
+    cctx = zstd.ZstdCompressor(level=level)
+    entries = []
+    for chunk in chunks:
+        frame = cctx.compress(chunk)
+        fh.write(frame)
+        entries.append(struct.pack("<II", len(frame), len(chunk)))
+    table = b"".join(entries)
+    fh.write(struct.pack("<II", SKIPPABLE_MAGIC_NUMBER, len(table) + FOOTER_SIZE))
+    fh.write(table)
+    fh.write(struct.pack("<IBI", len(entries), 0, SEEKABLE_MAGIC_NUMBER))
+
+
+def _read_frame(fh, dctx, frame):
+    offset, compressed_size, decompressed_size = frame
+    fh.seek(offset)
+    return dctx.decompress(fh.read(compressed_size), max_output_size=decompressed_size)
+
+
+def iter_range_lines(fh, frames, first, last):
+    """Yield the lines (bytes, with their newline) starting in frames [first, last)."""
+    dctx = zstd.ZstdDecompressor()
+    skipping = first > 0
+    buffer = b""
+    for index in range(first, len(frames)):
+        data = _read_frame(fh, dctx, frames[index])
+        if skipping:
+            # The line in progress belongs to the previous range
+            newline = data.find(b"\n")
+            if newline < 0:
+                if index + 1 >= last:
+                    return
+                continue
+            data = data[newline + 1:]
+            skipping = False
+        if index >= last:
+            # Only finish the line spanning the end of the range
+            newline = data.find(b"\n")
+            if newline < 0:
+                buffer += data
+                continue
+            yield buffer + data[:newline + 1]
+            return
+        buffer += data
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if buffer:
+        yield buffer
+
+
+def split_frames(frames, parts):
+    """Split the frames in at most parts contiguous ranges of similar size."""
+    total = sum(frame[2] for frame in frames)
+    ranges = []
+    first = 0
+    done = 0
+    for index, frame in enumerate(frames):
+        done += frame[2]
+        if done * parts >= total * (len(ranges) + 1) or index == len(frames) - 1:
+            ranges.append((first, index + 1))
+            first = index + 1
+    return ranges
+
+
+def _decode(lines):
+    for line in lines:
+        yield line.decode("utf-8")
+
+
+def _map_range(file_path, frames, first, last, fn):
+    with open(file_path, "rb") as fh:
+        return fn(_decode(iter_range_lines(fh, frames, first, last)))
+
+
+def map_lines(file_path, fn, jobs=1):
+    """
+    Call fn(lines) on the text lines of a zstd file and return the list of
+    results, in file order. With jobs > 1 and a seek table, fn is called
+    once per frame range in a pool of processes, and the caller merges the
+    partial results. Otherwise fn is called once with all the lines.
+    """
+    frames = None
+    if jobs > 1:
+        with open(file_path, "rb") as fh:
+            frames = read_seek_table(fh)
+    if not frames:
+        with open(file_path, "rb") as fh:
+            with zstd.ZstdDecompressor().stream_reader(fh) as reader:
+                return [fn(io.TextIOWrapper(reader, encoding="utf-8"))]
+
+    ranges = split_frames(frames, jobs * 4)
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(_map_range, file_path, frames, first, last, fn)
+            for first, last in ranges
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,63 @@
+"""Check the analytic block counts of the LD cluster renderer."""
+
+import numpy as np
+
+import make_isbn_images_fractal_cluster as ld
+from isbn_intervals import IntervalSet
+
+N_BLOCKS = 10**ld.LEN_SHORT_ISBN // ld.SCALE_SQUARED
+
+
+def naive_counts(starts, ends):
+    counts = np.zeros(N_BLOCKS, dtype=np.int64)
+    for start, end in zip(starts, ends):
+        for position in range(start, end):
+            counts[position // ld.SCALE_SQUARED] += 1
+    return counts
+
+
+def check(starts, ends):
+    counts = ld.count_blocks(IntervalSet(starts, ends))
+    assert counts.dtype == np.int64
+    assert (counts == naive_counts(starts, ends)).all()
+
+
+def test_empty():
+    counts = ld.count_blocks(IntervalSet())
+    assert counts.dtype == np.int64 and counts.shape == (N_BLOCKS,)
+    assert not counts.any()
+
+
+def test_single_multi_block_run():
+    check([0], [5000])
+    check([1234], [9876])
+
+
+def test_runs_inside_and_across_blocks():
+    check([10, 2400, 7600, 12000], [20, 2600, 7700, 20001])
+
+
+def pixel_density(intervals):
+    """Density image of the pixel engine, as an array."""
+    image = ld.Image.new("F", (ld.WIDTH, ld.HEIGHT), 0.0)
+    ld.color_image(image, intervals.to_packed(), addcolor=1.0 / float(ld.SCALE_SQUARED))
+    return np.asarray(image)
+
+
+def test_color_image_credits_every_block():
+    # A run over 4 blocks, starting and ending inside one, and a short run
+    intervals = IntervalSet([1000, 30000], [9000, 30010])
+    density = pixel_density(intervals)
+    counts = ld.count_blocks(intervals)
+    xs, ys = ld.get_block_xy()
+    blocks = np.flatnonzero(counts)
+    assert blocks.tolist() == [0, 1, 2, 3, 12]
+    assert np.allclose(density[ys[blocks], xs[blocks]] * ld.SCALE_SQUARED, counts[blocks])
+    assert np.isclose(density.sum() * ld.SCALE_SQUARED, intervals.count())
+
+
+def test_pixel_and_numpy_engines_agree():
+    rng = np.random.default_rng(978)
+    starts = np.sort(rng.choice(10**7, 500, replace=False))
+    intervals = IntervalSet.from_intervals(starts, starts + rng.integers(1, 20000, len(starts)))
+    assert np.allclose(pixel_density(intervals), np.asarray(ld.density_image(intervals)), atol=1e-6)
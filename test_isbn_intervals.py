@@ -0,0 +1,94 @@
+"""Check the IntervalSet run algebra against naive sets of positions."""
+
+import numpy as np
+import pytest
+
+from isbn_intervals import IntervalSet, decode_intervals
+
+UNIVERSE = 200
+
+
+def positions(intervals):
+    return {p for start, end in zip(intervals.starts.tolist(), intervals.ends.tolist()) for p in range(start, end)}
+
+
+def naive(starts, ends):
+    return {p for start, end in zip(starts, ends) for p in range(start, end)}
+
+
+def check_runs(intervals):
+    """Runs sorted, not empty, disjoint and not adjacent."""
+    assert (intervals.starts < intervals.ends).all()
+    assert (intervals.starts[1:] > intervals.ends[:-1]).all()
+
+
+def random_runs(rng, count):
+    starts = rng.integers(0, UNIVERSE, count)
+    return starts, starts + rng.integers(0, 30, count)
+
+
+CASES = {
+    "empty": ([], []),
+    "empty runs": ([5, 40], [5, 40]),
+    "adjacent": ([0, 10, 20], [10, 20, 25]),
+    "nested": ([10, 12, 15], [50, 20, 16]),
+    "overlapping": ([10, 30, 5], [35, 60, 12]),
+}
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_from_intervals(name):
+    starts, ends = CASES[name]
+    intervals = IntervalSet.from_intervals(starts, ends)
+    check_runs(intervals)
+    assert positions(intervals) == naive(starts, ends)
+    assert intervals.count() == len(naive(starts, ends))
+
+
+def test_normalisation():
+    assert len(IntervalSet.from_intervals(*CASES["adjacent"])) == 1
+    assert len(IntervalSet.from_intervals(*CASES["nested"])) == 1
+    assert len(IntervalSet.from_intervals(*CASES["empty runs"])) == 0
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_set_operations(seed):
+    rng = np.random.default_rng(seed)
+    a_runs = random_runs(rng, rng.integers(0, 8))
+    b_runs = random_runs(rng, rng.integers(0, 8))
+    a = IntervalSet.from_intervals(*a_runs)
+    b = IntervalSet.from_intervals(*b_runs)
+    a_set = naive(*a_runs)
+    b_set = naive(*b_runs)
+    for result, expected in (
+        (a | b, a_set | b_set),
+        (a & b, a_set & b_set),
+        (a - b, a_set - b_set),
+        (a ^ b, a_set ^ b_set),
+    ):
+        check_runs(result)
+        assert positions(result) == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_queries(seed):
+    rng = np.random.default_rng(seed)
+    runs = random_runs(rng, 10)
+    intervals = IntervalSet.from_intervals(*runs)
+    expected = naive(*runs)
+    points = np.arange(-5, UNIVERSE + 35)
+    assert intervals.contains(points).tolist() == [p in expected for p in points.tolist()]
+    assert intervals.count_before(points).tolist() == [
+        sum(q < p for q in expected) for p in points.tolist()
+    ]
+    assert positions(intervals.clip([0, 50], [30, 120])) == {p for p in expected if 0 <= p < 30 or 50 <= p < 120}
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_packed_round_trip(name):
+    intervals = IntervalSet.from_intervals(*CASES[name])
+    packed = intervals.to_packed()
+    assert positions(IntervalSet.from_packed(packed)) == positions(intervals)
+    starts, ends = decode_intervals(packed)
+    assert starts.tolist() == intervals.starts.tolist() and ends.tolist() == intervals.ends.tolist()
+    assert positions(IntervalSet.from_bytes(intervals.to_bytes())) == positions(intervals)
@@ -0,0 +1,164 @@
+"""Check the Layout mapping against the original string based functions.
+
+The reference functions below are get_recursive_xy and find_isbn_from_xy
+of make_isbn_images_fractal.py (HD) and make_isbn_images_fractal_cluster.py
+(LD) as they were before isbn_layout.py, returning positions instead of
+ISBNs. The only intended change is outside of the image, where Layout gives
+None (-1 in arrays) while the old functions could return a position.
+"""
+
+import numpy as np
+import pytest
+
+import make_isbn_images_fractal as hd
+import make_isbn_images_fractal_cluster as ld
+
+LEN_SHORT_ISBN = 10
+SAMPLES = 100000
+
+
+def old_hd_get_xy(position, vector=hd.VECTOR):
+    coords = [0, 0]
+    isbn_str = str(position).zfill(LEN_SHORT_ISBN)
+    for i in range(LEN_SHORT_ISBN - 1):
+        digit = int(isbn_str[i])
+        coords[(i + 1) % 2] += digit * vector[i]
+    digit = int(isbn_str[LEN_SHORT_ISBN - 1])
+    coords[0] += digit % 5
+    coords[1] += digit // 5
+    return coords[0], coords[1]
+
+
+def old_hd_find_position(x, y, vector=hd.VECTOR):
+    isbn_digits = [0] * LEN_SHORT_ISBN
+    remaining_x = x
+    remaining_y = y
+    for i in range(LEN_SHORT_ISBN - 1):
+        if (i + 1) % 2 == 0:
+            digit = remaining_x // vector[i]
+            remaining_x = remaining_x % vector[i]
+        else:
+            digit = remaining_y // vector[i]
+            remaining_y = remaining_y % vector[i]
+        if 0 <= digit <= 9:
+            isbn_digits[i] = digit
+        else:
+            return None
+    last_digit = (remaining_y * 5) + remaining_x
+    if 0 <= last_digit <= 9:
+        isbn_digits[LEN_SHORT_ISBN - 1] = last_digit
+        return int("".join(map(str, isbn_digits)))
+    return None
+
+
+def old_ld_get_xy(position, vector=ld.VECTOR, scale_squared=ld.SCALE_SQUARED):
+    coords = [0, 0]
+    isbn_str = str(position).zfill(LEN_SHORT_ISBN)
+    for i in range(len(vector)):
+        digit = int(isbn_str[i])
+        coords[(i + 1) % 2] += digit * vector[i]
+    last_four = int(isbn_str[len(vector):])
+    coords[1] += last_four // scale_squared
+    return coords[0], coords[1]
+
+
+def old_ld_find_position(x, y, vector=ld.VECTOR, scale_squared=ld.SCALE_SQUARED):
+    for last_four in [0, 2500, 5000, 7500]:
+        isbn_digits = [0] * LEN_SHORT_ISBN
+        isbn_digits[len(vector):] = [int(d) for d in str(last_four).zfill(4)]
+        remaining_x = x
+        remaining_y = y - (last_four // scale_squared)
+        for i in range(len(vector)):
+            if (i + 1) % 2 == 0:
+                digit = remaining_x // vector[i]
+                remaining_x = remaining_x % vector[i]
+            else:
+                digit = remaining_y // vector[i]
+                remaining_y = remaining_y % vector[i]
+            if 0 <= digit <= 9:
+                isbn_digits[i] = digit
+            else:
+                break
+        if remaining_x == 0 and remaining_y == 0:
+            return int("".join(map(str, isbn_digits)))
+    return None
+
+
+LAYOUTS = {
+    "hd": (hd.LAYOUT, old_hd_get_xy, old_hd_find_position),
+    "ld": (ld.LAYOUT, old_ld_get_xy, old_ld_find_position),
+}
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(978)
+
+
+@pytest.mark.parametrize("name", LAYOUTS)
+def test_get_xy_matches_old(name, rng):
+    layout, old_get_xy, _ = LAYOUTS[name]
+    positions = rng.integers(0, 10**LEN_SHORT_ISBN, SAMPLES)
+    expected = np.array([old_get_xy(int(p)) for p in positions])
+    xs, ys = layout.get_xy(positions)
+    assert (xs == expected[:, 0]).all() and (ys == expected[:, 1]).all()
+    for position, (x, y) in zip(positions[:1000], expected):
+        assert layout.get_xy(int(position)) == (x, y)
+
+
+@pytest.mark.parametrize("name", LAYOUTS)
+def test_find_position_matches_old_inside_image(name, rng):
+    layout, _, old_find_position = LAYOUTS[name]
+    if name == "ld":
+        # Every pixel of the LD image
+        ys, xs = np.mgrid[0 : layout.height, 0 : layout.width]
+        xs = xs.ravel()
+        ys = ys.ravel()
+    else:
+        xs = rng.integers(0, layout.width, SAMPLES)
+        ys = rng.integers(0, layout.height, SAMPLES)
+    expected = np.array([old_find_position(int(x), int(y)) for x, y in zip(xs, ys)])
+    assert (layout.find_position(xs, ys) == expected).all()
+    for x, y, position in zip(xs[:1000], ys[:1000], expected):
+        assert layout.find_position(int(x), int(y)) == position
+
+
+@pytest.mark.parametrize("name", LAYOUTS)
+def test_round_trip(name, rng):
+    layout, _, _ = LAYOUTS[name]
+    xs = rng.integers(0, layout.width, SAMPLES)
+    ys = rng.integers(0, layout.height, SAMPLES)
+    positions = layout.find_position(xs, ys)
+    back_xs, back_ys = layout.get_xy(positions)
+    assert (back_xs == xs).all() and (back_ys == ys).all()
+    # Every position of a pixel maps back to it, the first one being found
+    offsets = rng.integers(0, layout.positions_per_pixel, SAMPLES)
+    back_xs, back_ys = layout.get_xy(positions + offsets)
+    assert (back_xs == xs).all() and (back_ys == ys).all()
+
+
+@pytest.mark.parametrize("name", LAYOUTS)
+def test_find_position_outside_image(name, rng):
+    layout, _, _ = LAYOUTS[name]
+    # Left, right, below and above the image
+    xs = np.concatenate((
+        rng.integers(-layout.width, 0, 1000),
+        rng.integers(layout.width, 10 * layout.width, 1000),
+        rng.integers(0, layout.width, 2000),
+    ))
+    ys = np.concatenate((
+        rng.integers(0, layout.height, 2000),
+        rng.integers(layout.height, 5 * layout.height, 1000),
+        rng.integers(-layout.height, 0, 1000),
+    ))
+    assert (layout.find_position(xs, ys) == -1).all()
+    for x, y in zip(xs[::50], ys[::50]):
+        assert layout.find_position(int(x), int(y)) is None
+
+
+def test_old_functions_answered_outside_image():
+    # Pixels below (HD) or right of (LD) the image used to give a position
+    assert old_hd_find_position(0, hd.HEIGHT) is not None
+    assert hd.LAYOUT.find_position(0, hd.HEIGHT) is None
+    assert old_ld_find_position(ld.WIDTH, 0) is not None
+    assert ld.LAYOUT.find_position(ld.WIDTH, 0) is None
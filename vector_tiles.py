@@ -0,0 +1,237 @@
+"""Cut the features of make_isbn_json.py into vector tiles.
+
+Every polygon of make_isbn_json.py is an axis aligned rectangle, so the
+tiles it intersects are found arithmetically and it is clipped by taking
+the intersection of the two rectangles. Label points go to the tile
+containing them.
+
+Coordinates are kept in map units (pixels of the image times --scale). A
+tile of zoom z spans tile_size * 2**(max_zoom - z) map units, max zoom being
+by default the first zoom where the whole map fits in one tile at zoom 0.
+Tiles are written as compact GeoJSON FeatureCollections to
+<output>/<z>/<x>/<y>.json.
+
+This is not the format of the tiles cut by tiling_isbn.py of microjson,
+which the web client loads from vt_ld and vt_hd: those are geojson-vt tiles
+in tile-local coordinates (protobuf .pbf with its last argument true), with
+a metadata file. The tiles written here have absolute map coordinates and
+no metadata, and are meant for scripts and inspection, not for the client. While the features are read, the clipped ones
+are buffered and regularly appended to one NDJSON spill file per tile in a
+temporary directory, so memory does not grow with the number of tiles.
+
+With --lod, features only go to the zooms where they are at least one
+pixel (or --lod-pixels) wide or high, a map unit being a pixel at max zoom:
+low zooms only carry the large prefixes. Features annotated with minzoom and maxzoom
+properties (make_isbn_json.py --lod) use these zooms instead.
+
+Usage:
+    vector_tiles.py [options] <input> <output>
+
+Options:
+    --scale=<scale>         GeoJSON scale factor used to generate the input [default: 32]
+    --hd                    Input generated with --hd
+    -t --tile-size=<n>      Tile size in map units at the max zoom [default: 512]
+    --min-zoom=<z>          Lowest zoom level [default: 0]
+    --max-zoom=<z>          Highest zoom level, computed from the map size by default
+    --lod                   Drop the features smaller than a pixel from the low zooms
+    --lod-pixels=<n>        Minimum size in pixels of the features kept by --lod [default: 1]
+    -h --help               Show this help message
+
+Example:
+    python vector_tiles.py data_ld.json vt_ld_geojson --scale 32
+    python vector_tiles.py data_hd.ndjson.zst vt_hd_geojson --scale 4 --hd --lod
+"""
+
+import json
+import math
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+
+from docopt import docopt
+
+from geojson_stream import COMPACT_SEPARATORS, GeoJSONWriter, iter_features
+
+# Clipped features kept in memory before being appended to the spill files
+BUFFER_FEATURES = 1 << 16
+
+
+def default_max_zoom(width, height, tile_size):
+    """Zoom where tiles are tile_size wide when zoom 0 holds the whole map."""
+    return max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+
+
+def feature_bounds(feature):
+    """(x0, y0, x1, y1) of a rectangle Polygon or a Point feature."""
+    geometry = feature["geometry"]
+    if geometry["type"] == "Point":
+        x, y = geometry["coordinates"]
+        return x, y, x, y
+    ring = geometry["coordinates"][0]
+    xs = [point[0] for point in ring]
+    ys = [point[1] for point in ring]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def feature_size(feature):
+    """Width and height in map units of a rectangle, or of the rectangle of a label point."""
+    if feature["geometry"]["type"] == "Point":
+        return feature["properties"].get("width", 0), feature["properties"].get("height", 0)
+    x0, y0, x1, y1 = feature_bounds(feature)
+    return x1 - x0, y1 - y0
+
+
+def feature_zooms(feature, min_zoom, max_zoom, min_pixels=1):
+    """
+    (minzoom, maxzoom) of a feature: from the first zoom where it is at
+    least min_pixels wide or high, to max_zoom. Features smaller than that
+    at max_zoom are only kept at max_zoom.
+    """
+    size = max(feature_size(feature)) / min_pixels
+    if size < 1:
+        return max_zoom, max_zoom
+    return min(max(max_zoom - math.floor(math.log2(size)), min_zoom), max_zoom), max_zoom
+
+
+def annotate_zooms(feature, min_zoom, max_zoom, min_pixels=1):
+    """Add the minzoom and maxzoom properties of feature_zooms() to a feature."""
+    minzoom, maxzoom = feature_zooms(feature, min_zoom, max_zoom, min_pixels)
+    feature["properties"]["minzoom"] = minzoom
+    feature["properties"]["maxzoom"] = maxzoom
+    return feature
+
+
+def clip_rectangle(feature, x0, y0, x1, y1):
+    """Copy of a rectangle feature with its polygon replaced by (x0, y0, x1, y1)."""
+    return {
+        **feature,
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]],
+        },
+    }
+
+
+class VectorTiler:
+    """
+    Spill features to the tiles of every zoom level, then write them. Spill
+    files go to a temporary directory, created in spill_dir if given.
+    """
+
+    def __init__(self, width, height, tile_size=512, min_zoom=0, max_zoom=None, lod=False, min_pixels=1,
+                 spill_dir=None, buffer_features=BUFFER_FEATURES):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.min_zoom = min_zoom
+        self.max_zoom = default_max_zoom(width, height, tile_size) if max_zoom is None else max_zoom
+        self.lod = lod
+        self.min_pixels = min_pixels
+        self.buffer_features = buffer_features
+        self.buffer = defaultdict(list)
+        self.buffered = 0
+        self.spill_dir = tempfile.mkdtemp(prefix="vector_tiles_", dir=spill_dir)
+        self.tiles = set()
+
+    def tile_side(self, zoom):
+        return self.tile_size * 2 ** (self.max_zoom - zoom)
+
+    def tile_count(self, zoom):
+        side = self.tile_side(zoom)
+        return math.ceil(self.width / side), math.ceil(self.height / side)
+
+    def zoom_range(self, feature):
+        properties = feature["properties"]
+        if "minzoom" in properties:
+            min_zoom, max_zoom = properties["minzoom"], properties["maxzoom"]
+        elif self.lod:
+            min_zoom, max_zoom = feature_zooms(feature, self.min_zoom, self.max_zoom, self.min_pixels)
+        else:
+            min_zoom, max_zoom = self.min_zoom, self.max_zoom
+        return range(max(min_zoom, self.min_zoom), min(max_zoom, self.max_zoom) + 1)
+
+    def add(self, feature):
+        x0, y0, x1, y1 = feature_bounds(feature)
+        is_point = feature["geometry"]["type"] == "Point"
+        for zoom in self.zoom_range(feature):
+            side = self.tile_side(zoom)
+            cols, rows = self.tile_count(zoom)
+            if is_point:
+                col = min(max(int(x0 // side), 0), cols - 1)
+                row = min(max(int(y0 // side), 0), rows - 1)
+                self._append((zoom, col, row), feature)
+                continue
+            # Rectangles exclude their right and bottom edges
+            for col in range(max(int(x0 // side), 0), min(math.ceil(x1 / side), cols)):
+                for row in range(max(int(y0 // side), 0), min(math.ceil(y1 / side), rows)):
+                    tile_x0, tile_y0 = col * side, row * side
+                    if x0 >= tile_x0 and y0 >= tile_y0 and x1 <= tile_x0 + side and y1 <= tile_y0 + side:
+                        self._append((zoom, col, row), feature)
+                    else:
+                        self._append((zoom, col, row), clip_rectangle(
+                            feature,
+                            max(x0, tile_x0),
+                            max(y0, tile_y0),
+                            min(x1, tile_x0 + side),
+                            min(y1, tile_y0 + side),
+                        ))
+
+    def _append(self, tile, feature):
+        self.buffer[tile].append(json.dumps(feature, separators=COMPACT_SEPARATORS) + "\n")
+        self.buffered += 1
+        if self.buffered >= self.buffer_features:
+            self.flush()
+
+    def spill_file(self, tile):
+        return "{}/{}_{}_{}.ndjson".format(self.spill_dir, *tile)
+
+    def flush(self):
+        """Append the buffered features to the spill files of their tiles."""
+        for tile, lines in self.buffer.items():
+            with open(self.spill_file(tile), "a") as f:
+                f.writelines(lines)
+            self.tiles.add(tile)
+        self.buffer.clear()
+        self.buffered = 0
+
+    def write(self, output_dir):
+        """Write the non empty tiles, return their number."""
+        self.flush()
+        try:
+            for zoom, col, row in sorted(self.tiles):
+                os.makedirs(f"{output_dir}/{zoom}/{col}", exist_ok=True)
+                with open(self.spill_file((zoom, col, row))) as spill, \
+                        GeoJSONWriter(f"{output_dir}/{zoom}/{col}/{row}.json", "compact") as writer:
+                    for line in spill:
+                        writer.write(json.loads(line))
+        finally:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        return len(self.tiles)
+
+
+def main():
+    args = docopt(__doc__)
+    geojson_scale = int(args["--scale"])
+    if args["--hd"]:
+        from make_isbn_images_fractal import HEIGHT, WIDTH
+    else:
+        from make_isbn_images_fractal_cluster import HEIGHT, WIDTH
+    max_zoom = int(args["--max-zoom"]) if args["--max-zoom"] else None
+    tiler = VectorTiler(
+        WIDTH * geojson_scale,
+        HEIGHT * geojson_scale,
+        int(args["--tile-size"]),
+        int(args["--min-zoom"]),
+        max_zoom,
+        args["--lod"],
+        float(args["--lod-pixels"]),
+    )
+    for feature in iter_features(args["<input>"]):
+        tiler.add(feature)
+    count = tiler.write(args["<output>"])
+    print(f"{count} vector tiles generated in {args['<output>']}, zoom {tiler.min_zoom} to {tiler.max_zoom}")
+
+
+if __name__ == "__main__":
+    main()